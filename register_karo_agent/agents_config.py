@@ -4,7 +4,6 @@ Configuration file for OpenAI Agents SDK
 import os
 import logging
 from dotenv import load_dotenv
-from openai import OpenAI
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -21,10 +20,6 @@ if not api_key:
 else:
     logger.info(f"Using OpenAI API key: {api_key[:5]}...{api_key[-5:]}")
     
-    # Configure the OpenAI client explicitly
-    client = OpenAI(api_key=api_key)
-    
     # Set the API key in the environment for the Agents SDK to use
-    os.environ["OPENAI_API_KEY"] = api_key
-    
-    logger.info("OpenAI client configured successfully with API key")
\ No newline at end of file
+    # The client itself is created once by the app, on the shared pooled HTTP transport
+    os.environ["OPENAI_API_KEY"] = api_key
\ No newline at end of file
@@ -37,7 +37,7 @@ else:
         logger.warning("Could not set API key in agents._config")
 
 # Now import from agents package
-from agents import Agent, Runner, function_tool
+from agents import Agent, Runner, function_tool, set_default_openai_client
 
 # Export these symbols
-__all__ = ['Agent', 'Runner', 'function_tool']
\ No newline at end of file
+__all__ = ['Agent', 'Runner', 'function_tool', 'set_default_openai_client']
\ No newline at end of file
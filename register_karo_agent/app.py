@@ -1,36 +1,42 @@
 import os
-import json
 import uuid
 import re
+import random
 from bson import ObjectId
 import asyncio
 import logging
-from datetime import datetime
-from typing import List, Dict, Any, Optional
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from typing import List, Dict, Any, Optional, Callable, Awaitable, Set
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, File, Form, UploadFile, Request
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import HTMLResponse, ORJSONResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from pydantic import BaseModel
 import uvicorn
 from starlette.websockets import WebSocketState
 from dotenv import load_dotenv
+import httpx
+import orjson
+import aiofiles
+from cachetools import LRUCache
+from openai import AsyncOpenAI
 
-# Custom JSON encoder for MongoDB ObjectId
-class MongoJSONEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, ObjectId):
-            return str(obj)
-        return super().default(obj)
+# orjson serializes datetimes natively; ObjectIds are the only MongoDB type it needs help with
+def _json_default(obj):
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
 
-# Helper function to convert MongoDB documents to serializable dictionaries
-def mongo_to_json_serializable(data):
+def json_dumps(data: Any, sort_keys: bool = False) -> str:
     """
-    Delegate to the UserProfile helper method for MongoDB serialization.
-    This ensures consistent serialization across the application.
+    Serialize data, including MongoDB documents, to a JSON string.
+    Used for outgoing WebSocket frames and the JSON blocks in agent prompts.
     """
-    from database.models import UserProfile
-    return UserProfile.mongo_to_json_serializable(data)
+    option = orjson.OPT_SORT_KEYS if sort_keys else 0
+    return orjson.dumps(data, default=_json_default, option=option).decode()
 
 # Load environment variables from .env file if present
 load_dotenv()
@@ -58,14 +64,17 @@ except ImportError:
 import agents_config
 
 # Import from agents library
-from agents_new import Agent, Runner
+from agents_new import Agent, Runner, set_default_openai_client
 
 # Import our agents and tools
 from agents_new.sales_agent import sales_agent
 from agents_new.document_agent import document_verification_agent
 from agents_new.payment_agent import payment_agent
-from tools.document_tools import verify_document_with_vision
+from tools.document_tools import verify_document_with_vision, set_openai_client
 from tools.payment_tools import generate_razorpay_link, check_payment_status
+from llm_cache import llm_cache, result_is_cacheable
+from contact_extraction import extract_contact_details
+from session_store import SessionStore, SessionState, MongoSessionStore, InMemorySessionStore
 
 # Configure logging with absolute path for log file
 import os
@@ -92,17 +101,72 @@ if not os.environ.get("OPENAI_API_KEY"):
 if not os.environ.get("RAZORPAY_KEY_ID") or not os.environ.get("RAZORPAY_KEY_SECRET"):
     logger.warning("Razorpay API keys not set. Payment functionality will be simulated.")
 
+# Worker threads for blocking PyMongo/Cloudinary calls run via asyncio.to_thread,
+# sized to match the MongoClient connection pool (PyMongo default maxPoolSize)
+BLOCKING_IO_WORKERS = 100
+
+# Mongo connections opened at startup, matching the client's minPoolSize
+MONGO_WARM_CONNECTIONS = 5
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Create the shared HTTP clients once per process and close them on shutdown.
+    Every LLM and vision call reuses the same connection pool instead of opening
+    a new TLS connection per request.
+    """
+    # The default executor only has min(32, cpu + 4) threads, which would cap
+    # concurrent database calls well below the Mongo connection pool
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=BLOCKING_IO_WORKERS, thread_name_prefix="blocking-io")
+    )
+    
+    # Connect here rather than on the first request: uvicorn imports this module fresh, so the
+    # initialization under __main__ never runs in the serving process. A no-op once connected.
+    if DB_AVAILABLE:
+        await asyncio.to_thread(mongo_db.initialize)
+    
+    # Concurrent pings each check out their own socket, so the first requests skip the TCP/TLS handshake
+    if DB_AVAILABLE and mongo_db.is_connected:
+        await asyncio.gather(
+            *(asyncio.to_thread(mongo_db.db.command, "ping") for _ in range(MONGO_WARM_CONNECTIONS)),
+            return_exceptions=True
+        )
+        logger.info(f"Warmed {MONGO_WARM_CONNECTIONS} MongoDB connections")
+    
+    app.state.http = httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=100, max_connections=500),
+        timeout=httpx.Timeout(60.0, connect=10.0)
+    )
+    
+    api_key = os.environ.get("OPENAI_API_KEY")
+    if api_key:
+        app.state.openai = AsyncOpenAI(api_key=api_key, http_client=app.state.http)
+        # Used by Runner.run for all agents and by the document vision tool
+        set_default_openai_client(app.state.openai)
+        set_openai_client(app.state.openai)
+        logger.info("Shared OpenAI client configured with pooled HTTP connections")
+    
+    yield
+    
+    await app.state.http.aclose()
+    logger.info("Shared HTTP client closed")
+
 # Create FastAPI app
-app = FastAPI(title="RegisterKaro AI Sales Agent")
+# JSON endpoints are rendered with orjson, the same encoder used for WebSocket frames
+app = FastAPI(title="RegisterKaro AI Sales Agent", lifespan=lifespan, default_response_class=ORJSONResponse)
 
 # Mount static files using absolute paths
 import os
 static_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
 templates_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates")
+uploads_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "uploads")
 
 # Create directories if they don't exist
 os.makedirs(static_dir, exist_ok=True)
 os.makedirs(templates_dir, exist_ok=True)
+os.makedirs(uploads_dir, exist_ok=True)
 
 app.mount("/static", StaticFiles(directory=static_dir), name="static")
 
@@ -110,244 +174,473 @@ app.mount("/static", StaticFiles(directory=static_dir), name="static")
 templates = Jinja2Templates(directory=templates_dir)
 
 # In-memory storage as fallback
-chat_histories: Dict[str, List[Dict[str, str]]] = {}  # session_id -> list of messages
-user_info: Dict[str, Dict[str, Any]] = {}  # session_id -> user info
-document_status: Dict[str, Dict[str, Any]] = {}  # session_id -> document status
-payment_status: Dict[str, Dict[str, Any]] = {}  # session_id -> payment status
-thread_ids: Dict[str, str] = {}  # session_id -> OpenAI thread ID
+sessions: Dict[str, SessionState] = {}  # session_id -> history, user info, document, payment and summary state
+session_suffixes: Dict[str, str] = {}  # last 8 characters of a session_id -> first session in sessions with them
+
+# Session storage used by the chat flow, chosen once at startup
+memory_store = InMemorySessionStore(sessions, session_suffixes)
+store: SessionStore = MongoSessionStore() if DB_AVAILABLE else memory_store
 
 # Active WebSocket connections
 active_connections: Dict[str, WebSocket] = {}
 
+# Minimum seconds between last_active writes for a session on message frames
+LAST_ACTIVE_INTERVAL = 5
+last_active_written: LRUCache = LRUCache(maxsize=10000)  # session_id -> monotonic time of last write
+
+# Serialized user/document/payment blocks of inactivity prompts: session_id -> (version, text)
+inactivity_blocks: LRUCache = LRUCache(maxsize=10000)
+
+# User document fields that are not part of the stable user profile in agent prompts
+VOLATILE_USER_FIELDS = {"conversation", "document", "payment", "context_summary", "summary_state", "english_turns", "last_active", "message_count"}
+
+# Profile fields passed to the payment link as customer details
+CUSTOMER_INFO_FIELDS = ("name", "email", "phone")
+# Characters stripped from payment IDs received in URLs
+PAYMENT_ID_UNSAFE_RE = re.compile(r'[^a-zA-Z0-9_-]')
+# Characters replaced in uploaded file names before they become part of a path; dots are kept for the extension
+FILENAME_UNSAFE_RE = re.compile(r'[^a-zA-Z0-9._-]')
+# Bytes read from an uploaded document per disk write, so an upload is never held in memory whole
+UPLOAD_CHUNK_SIZE = 1 << 20
+# Razorpay statuses after which a payment no longer needs to be re-checked
+FINAL_PAYMENT_STATUSES = {"captured", "paid", "completed"}
+# Seconds a stored payment status is trusted before Razorpay is asked again
+PAYMENT_RECHECK_SECONDS = 10
+
+# Problems mentioned in a rejected document's analysis -> upload tip for the user
+DOCUMENT_ISSUES = {
+    "blurry": "Image is too blurry",
+    "dark": "Image is too dark",
+    "cropped": "Document is partially cropped or cut off",
+    "cut off": "Document is partially cropped or cut off",
+    "glare": "There's glare or reflection on the document",
+    "reflection": "There's glare or reflection on the document"
+}
+# All issue keywords in one alternation, so the analysis is scanned once
+DOCUMENT_ISSUE_RE = re.compile("|".join(re.escape(keyword) for keyword in DOCUMENT_ISSUES))
+
+# Static agent instructions at the start of every prompt, built once per agent type and language
+PROMPT_PREFIX = {
+    (agent_type, language): (
+        f"Respond as a {agent_type} agent.\n"
+        f"Language preference: {language}.\n"
+        "If language preference is Hinglish, respond in conversational Hindi-English mixed language, "
+        "using a natural and friendly tone like a human CA would speak to a client from North India.\n\n"
+    )
+    for agent_type in ("sales", "document verification", "payment")
+    for language in ("English", "Hinglish")
+}
+
+# Words that indicate the user is writing in Hinglish
+HINGLISH_INDICATORS = ["मैं", "हमें", "मेरा", "आप", "कैसे", "क्या", "नहीं", "है", "करना", "चाहिए"]
+HINGLISH_RE = re.compile("|".join(re.escape(word) for word in HINGLISH_INDICATORS))
+# English-only turns after which the language preference is fixed as English
+ENGLISH_TURNS_TO_CONFIRM = 3
+DEFAULT_SERVICE_TYPE = "Private Limited company registration"
+
+# Conversations this short at the sales stage get a template follow-up instead of an agent run
+INACTIVITY_TEMPLATE_MAX_MESSAGES = 2
+INACTIVITY_FOLLOW_UPS = {
+    "English": [
+        "Are you still there? I'd be happy to answer any questions about registering your company.",
+        "Just checking in - would you like to know what documents you need to get your company registered?",
+        "Still thinking it over? I can walk you through the registration process step by step whenever you're ready.",
+    ],
+    "Hinglish": [
+        "Kya aap abhi bhi yahan hain? Company registration ke baare mein koi bhi sawaal ho toh zaroor poochiye.",
+        "Bas check kar raha tha - kya aap jaanna chahenge ki registration ke liye kaunse documents chahiye?",
+        "Abhi soch rahe hain? Jab aap ready hon, main aapko registration ka poora process step by step samjha sakta hoon.",
+    ],
+}
+
+def summary_updates_for_message(message: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Work out which summary fields a single new message changes.
+    Only the returned fields are written, so keeping the summary current costs O(1) per message.
+    """
+    updates = {}
+    content = message.get("content", "").lower()
+    
+    if message.get("role") == "user":
+        if HINGLISH_RE.search(content):
+            updates["language"] = "Hinglish"
+        if "llp" in content or "limited liability partnership" in content:
+            updates["service_type"] = "LLP registration"
+        elif "opc" in content or "one person company" in content:
+            updates["service_type"] = "OPC registration"
+    
+    if "document" in content:
+        updates["mentions_document"] = True
+    if "payment" in content:
+        updates["mentions_payment"] = True
+    
+    return updates
+
+def rebuild_summary_state(history: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Rebuild the summary state from the last 10 messages to correct any drift."""
+    state = {
+        "language": "English",
+        "service_type": DEFAULT_SERVICE_TYPE,
+        "mentions_document": False,
+        "mentions_payment": False
+    }
+    for msg in history[-10:]:
+        state.update(summary_updates_for_message(msg))
+    return state
+
+async def add_to_chat_history(session_id: str, message: Dict[str, Any]) -> int:
+    """
+    Add a message to the chat history and apply its changes to the stored summary state.
+    Returns the new number of messages in the conversation.
+    """
+    return await store.append_message(session_id, message, summary_updates_for_message(message))
+
+def format_context_summary(state: Dict[str, Any], contact: Dict[str, Any],
+                           document: Optional[Dict[str, Any]], payment: Optional[Dict[str, Any]]) -> Dict[str, str]:
+    """Format the stored summary state into the detailed summary and the short context."""
+    user_name = contact.get("name", "")
+    user_email = contact.get("email", "")
+    user_phone = contact.get("phone", "")
+    language_preference = state.get("language", "English")
+    service_type = state.get("service_type", DEFAULT_SERVICE_TYPE)
+    
+    summary = f"User: {user_name} | Email: {user_email} | Phone: {user_phone}\n\n"
+    summary += f"Language preference: {language_preference}. "
+    summary += f"Interested in {service_type}. "
+    
+    if document is not None:
+        if document.get("verified"):
+            summary += "Document verified successfully. "
+        else:
+            summary += "Document verification in progress. "
+    
+    if payment is not None:
+        if payment.get("completed"):
+            summary += "Payment completed successfully. "
+        else:
+            summary += "Payment pending. "
+    
+    # Generate a short context (max 200 chars) for quick reference
+    short_context = f"{user_name or 'User'} is interested in {service_type}. "
+    
+    if document:
+        if document.get("verified"):
+            short_context += "Document verified. "
+        elif document.get("pending"):
+            short_context += "Awaiting document. "
+    
+    if payment:
+        if payment.get("completed"):
+            short_context += "Payment completed."
+        elif payment.get("pending"):
+            short_context += "Payment pending."
+    
+    short_context += f" Lang: {language_preference}."
+    
+    return {
+        "summary": summary,
+        "short_context": short_context[:200]  # Ensure it's not longer than 200 chars
+    }
+
 # Function to generate a context summary
 async def generate_context_summary(session_id: str) -> Dict[str, str]:
     """
-    Generate a context summary for a session using the chat history.
+    Generate a context summary for a session from its incrementally maintained summary state.
     Returns both a detailed summary and a short context (max 200 chars) for reconnection.
+    The state is rebuilt from recent history every 20 messages, or if it is missing.
     """
-    if DB_AVAILABLE:
-        user_data = UserProfile.get_by_session(session_id)
-        if user_data and "conversation" in user_data:
-            history = user_data["conversation"]
-            # Use only the last 10 messages for the summary
-            recent_history = history[-10:] if len(history) > 10 else history
-            
-            # Create a prompt for summarization
-            messages = []
-            for msg in recent_history:
-                role = msg.get("role", "unknown")
-                content = msg.get("content", "")
-                messages.append(f"{role}: {content}")
-                
-            prompt = "\n".join(messages)
-            prompt += "\n\nSummarize the key points from this conversation, including user needs, preferences, and any important details:"
-            
-            # In a production system, the following would use an LLM call for better summaries
-            # Extract key information
-            user_name = ""
-            user_email = ""
-            user_phone = ""
-            
-            if "contact" in user_data:
-                user_name = user_data["contact"].get("name", "")
-                user_email = user_data["contact"].get("email", "")
-                user_phone = user_data["contact"].get("phone", "")
-            
-            summary = f"User: {user_name} | Email: {user_email} | Phone: {user_phone}\n\n"
-            
-            # Determine if user is communicating in Hinglish
-            language_preference = "English"
-            hinglish_indicators = ["मैं", "हमें", "मेरा", "आप", "कैसे", "क्या", "नहीं", "है", "करना", "चाहिए"]
-            if any(any(hindi_word in msg.get("content", "").lower() for hindi_word in hinglish_indicators)
-                  for msg in recent_history if msg.get("role") == "user"):
-                language_preference = "Hinglish"
-                
-            summary += f"Language preference: {language_preference}. "
-            
-            # Simple keyword-based extraction for status
-            service_type = "Private Limited company registration"
-            for msg in recent_history:
-                if msg.get("role") == "user" and "content" in msg:
-                    content = msg["content"].lower()
-                    if "llp" in content or "limited liability partnership" in content:
-                        service_type = "LLP registration"
-                    elif "opc" in content or "one person company" in content:
-                        service_type = "OPC registration"
-            
-            summary += f"Interested in {service_type}. "
-                
-            if any("document" in m.get("content", "").lower() for m in recent_history):
-                doc_status = "Document verification in progress. "
-                if "document" in user_data and user_data["document"].get("verified"):
-                    doc_status = "Document verified successfully. "
-                summary += doc_status
-                
-            if any("payment" in m.get("content", "").lower() for m in recent_history):
-                payment_info = "Payment pending. "
-                if "payment" in user_data and user_data["payment"].get("completed"):
-                    payment_info = "Payment completed successfully. "
-                summary += payment_info
-                
-            # Generate a short context (max 200 chars) for quick reference
-            short_context = f"{user_name or 'User'} is interested in {service_type}. "
-            
-            if "document" in user_data:
-                if user_data["document"].get("verified"):
-                    short_context += "Document verified. "
-                elif user_data["document"].get("pending"):
-                    short_context += "Awaiting document. "
-            
-            if "payment" in user_data:
-                if user_data["payment"].get("completed"):
-                    short_context += "Payment completed."
-                elif user_data["payment"].get("pending"):
-                    short_context += "Payment pending."
-            
-            short_context += f" Lang: {language_preference}."
-            
-            return {
-                "summary": summary,
-                "short_context": short_context[:200]  # Ensure it's not longer than 200 chars
-            }
-        else:
-            return {
-                "summary": "No conversation history available for this user.",
-                "short_context": "New user, no conversation history."
-            }
-    else:
-        # Fallback to in-memory data if database is not available
-        if session_id not in chat_histories:
-            return {
-                "summary": "No conversation history available for this user.",
-                "short_context": "New user, no conversation history."
-            }
-            
-        history = chat_histories[session_id]
-        recent_history = history[-10:] if len(history) > 10 else history
-        
-        # Simple extraction for the MVP
-        user_name = user_info.get(session_id, {}).get("name", "")
-        user_email = user_info.get(session_id, {}).get("email", "")
-        user_phone = user_info.get(session_id, {}).get("phone", "")
-        
-        summary = f"User: {user_name} | Email: {user_email} | Phone: {user_phone}\n\n"
-        
-        # Determine if user is communicating in Hinglish
-        language_preference = "English"
-        hinglish_indicators = ["मैं", "हमें", "मेरा", "आप", "कैसे", "क्या", "नहीं", "है", "करना", "चाहिए"]
-        if any(any(hindi_word in msg.get("content", "").lower() for hindi_word in hinglish_indicators)
-              for msg in recent_history if msg.get("role") == "user"):
-            language_preference = "Hinglish"
-            
-        summary += f"Language preference: {language_preference}. "
-        
-        # Simple keyword-based extraction for status
-        service_type = "Private Limited company registration"
-        for msg in recent_history:
-            if msg.get("role") == "user" and "content" in msg:
-                content = msg["content"].lower()
-                if "llp" in content or "limited liability partnership" in content:
-                    service_type = "LLP registration"
-                elif "opc" in content or "one person company" in content:
-                    service_type = "OPC registration"
-        
-        summary += f"Interested in {service_type}. "
-        
-        # Add document and payment status
-        if session_id in document_status:
-            doc_status = "Document verification in progress. "
-            if document_status[session_id].get("verified"):
-                doc_status = "Document verified successfully. "
-            summary += doc_status
-            
-        if session_id in payment_status:
-            payment_info = "Payment pending. "
-            if payment_status[session_id].get("completed"):
-                payment_info = "Payment completed successfully. "
-            summary += payment_info
-        
-        # Generate a short context (max 200 chars) for quick reference
-        short_context = f"{user_name or 'User'} is interested in {service_type}. "
-        
-        if session_id in document_status:
-            if document_status[session_id].get("verified"):
-                short_context += "Document verified. "
-            elif document_status[session_id].get("pending"):
-                short_context += "Awaiting document. "
-        
-        if session_id in payment_status:
-            if payment_status[session_id].get("completed"):
-                short_context += "Payment completed."
-            elif payment_status[session_id].get("pending"):
-                short_context += "Payment pending."
-        
-        short_context += f" Lang: {language_preference}."
-        
+    user_data = await store.get(session_id, ["name", "email", "phone", "document", "payment", "summary_state", "message_count"])
+    if not user_data or not user_data.get("message_count"):
         return {
-            "summary": summary,
-            "short_context": short_context[:200]  # Ensure it's not longer than 200 chars
+            "summary": "No conversation history available for this user.",
+            "short_context": "New user, no conversation history."
         }
+    
+    state = user_data.get("summary_state")
+    if not state or user_data["message_count"] % 20 == 0:
+        # Only the last 10 messages are needed for the rebuild
+        state = rebuild_summary_state(await store.recent_messages(session_id, 10))
+        await store.set_summary_state(session_id, state)
+    
+    document = user_data.get("document", {}) if state.get("mentions_document") else None
+    payment = user_data.get("payment", {}) if state.get("mentions_payment") else None
+    return format_context_summary(state, user_data, document, payment)
+
+# Context summaries are refreshed off the message path, at most SUMMARY_CONCURRENCY at a time
+SUMMARY_CONCURRENCY = 4
+summary_semaphore = asyncio.Semaphore(SUMMARY_CONCURRENCY)
+summary_tasks: Dict[str, asyncio.Task] = {}  # session_id -> refresh in progress
+
+# Uploaded documents being verified after /upload-document has answered; held so the tasks are not garbage collected
+document_tasks: Set[asyncio.Task] = set()
+
+async def refresh_context_summary(session_id: str):
+    """Generate and store the context summary for a session."""
+    try:
+        async with summary_semaphore:
+            context_data = await generate_context_summary(session_id)
+            await store.update_context_summary(
+                session_id,
+                context_data["summary"],
+                context_data["short_context"]
+            )
+        logger.info(f"Updated context summary for session {session_id}")
+    except Exception as e:
+        logger.error(f"Error updating context summary for session {session_id}: {str(e)}", exc_info=True)
+    finally:
+        summary_tasks.pop(session_id, None)
+
+def schedule_context_summary(session_id: str):
+    """Refresh a session's context summary in the background unless a refresh is already running."""
+    if session_id not in summary_tasks:
+        summary_tasks[session_id] = asyncio.create_task(refresh_context_summary(session_id))
+
+# Most events merged into one frame from separate sends, so a backlog never builds one huge frame
+BATCH_MAX_EVENTS = 8
 
 # Helper functions
+def last_active_due(session_id: str) -> bool:
+    """Check whether a session's last_active timestamp is old enough to be written again."""
+    written_at = last_active_written.get(session_id)
+    return written_at is None or time.monotonic() - written_at >= LAST_ACTIVE_INTERVAL
+
+def seconds_since(timestamp: Any) -> float:
+    """
+    Seconds elapsed since a stored timestamp.
+    Datetimes read back from MongoDB are naive UTC; ISO strings written before timestamps were stored as dates are local time.
+    """
+    if isinstance(timestamp, str):
+        timestamp = datetime.fromisoformat(timestamp)
+        if timestamp.tzinfo is None:
+            timestamp = timestamp.astimezone()
+    elif timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return (datetime.now(timezone.utc) - timestamp).total_seconds()
+
+def serialize_user_blocks(session_id: str, user_data: Dict[str, Any]) -> str:
+    """
+    Serialize the user info, document status and payment status lines of an inactivity prompt.
+    The text is reused until its version changes: profile, identifier, message, document and payment writes
+    move last_active, context summaries stamp context_updated_at and case outcomes carry their own timestamp.
+    """
+    last_active = user_data.get("last_active")
+    version = (last_active, user_data.get("context_updated_at"), (user_data.get("case_outcome") or {}).get("timestamp"))
+    cached = inactivity_blocks.get(session_id)
+    if last_active and cached and cached[0] == version:
+        return cached[1]
+    
+    blocks = ""
+    
+    # Add user info, document status, payment status
+    user_info_data = {k: v for k, v in user_data.items() if k not in ["conversation", "document", "payment", "context_summary"]}
+    if user_info_data:
+        blocks += f"\nUser info: {json_dumps(user_info_data)}"
+    
+    # Add document status
+    if "document" in user_data:
+        blocks += f"\nDocument status: {json_dumps(user_data['document'])}"
+    
+    # Add payment status
+    if "payment" in user_data:
+        blocks += f"\nPayment status: {json_dumps(user_data['payment'])}"
+    
+    if last_active:
+        inactivity_blocks[session_id] = (version, blocks)
+    return blocks
+
+def is_connected(websocket: WebSocket) -> bool:
+    """Check whether the client side of a WebSocket is still open."""
+    return websocket.client_state is WebSocketState.CONNECTED
+
+def resolve_memory_session(session_id: str) -> str:
+    """
+    Map a session ID sent by the client to a known in-memory session.
+    Unknown IDs are matched to a session with the same last 8 characters, if there is one.
+    """
+    if session_id in active_connections or session_id in sessions:
+        return session_id
+    
+    conn_id = session_suffixes.get(session_id[-8:])
+    if conn_id:
+        logger.info(f"Mapped session ID {session_id} to {conn_id}")
+        return conn_id
+    return session_id
+
+def encode_events(events: List[Dict[str, Any]]) -> str:
+    """
+    Encode events as one WebSocket frame.
+    A single event is sent as-is; several are wrapped in a "batch" event the client unpacks in order.
+    """
+    if len(events) == 1:
+        return json_dumps(events[0])
+    return json_dumps({"type": "batch", "events": events})
+
+async def connection_writer(websocket: WebSocket, out_queue: asyncio.Queue):
+    """
+    Drain a connection's outbound queue onto the socket.
+    Runs as its own task so slow clients never block message processing.
+    Events queued while a send is in progress are merged into the next frame, up to BATCH_MAX_EVENTS.
+    The events of a single send always stay in one frame.
+    Once the writer stops, the queue is detached from the connection so nothing is queued for it any more.
+    """
+    try:
+        while True:
+            events = list(await out_queue.get())
+            while not out_queue.empty() and len(events) < BATCH_MAX_EVENTS:
+                events.extend(out_queue.get_nowait())
+            
+            if not is_connected(websocket):
+                break
+            
+            await websocket.send_text(encode_events(events))
+            logger.info(f"Sent {', '.join(event['type'] for event in events)} to client")
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.error(f"WebSocket writer stopped: {str(e)}")
+        # Without a writer the connection is unusable, so close it and let the receive loop clean up
+        try:
+            await websocket.close()
+        except Exception:
+            pass
+    finally:
+        websocket.state.out_queue = None
+
+async def send_bot_events(websocket: WebSocket, events: List[Dict[str, Any]]):
+    """
+    Send the events produced in one turn to the client.
+    Events go through the connection's outbound queue when it has one, otherwise they are written directly.
+    This is the one place that checks the connection; callers can send without checking it first.
+    """
+    if not events or not is_connected(websocket):
+        return
+    
+    out_queue = getattr(websocket.state, "out_queue", None)
+    if out_queue is not None:
+        # Never wait on a full queue: a client that stopped reading must not stall the turn
+        try:
+            out_queue.put_nowait(events)
+        except asyncio.QueueFull:
+            logger.warning(f"Outbound queue full, dropped {', '.join(event['type'] for event in events)}")
+        return
+    
+    try:
+        await websocket.send_text(encode_events(events))
+    except (WebSocketDisconnect, RuntimeError) as e:
+        # The client left between the check and the send; nothing to report beyond that
+        logger.warning(f"Client disconnected before {', '.join(event['type'] for event in events)} could be sent: {str(e)}")
+        return
+    logger.info(f"Sent {', '.join(event['type'] for event in events)} to client")
+
 async def send_bot_message(websocket: WebSocket, text: str, message_type: str = "message"):
     """Send a message from the bot to the client."""
-    if websocket.client_state == WebSocketState.CONNECTED:
-        await websocket.send_text(json.dumps({
-            "type": message_type,
-            "text": text
-        }))
-        logger.info(f"Sent {message_type} to client: {text[:50]}...")
-
-async def send_payment_link(websocket: WebSocket, link: str):
-    """Send a payment link to the client."""
-    if websocket.client_state == WebSocketState.CONNECTED:
-        await websocket.send_text(json.dumps({
-            "type": "payment_link",
-            "link": link
-        }))
-        logger.info(f"Sent payment link to client: {link}")
-
-async def request_document_upload(websocket: WebSocket):
-    """Request document upload from the client."""
-    if websocket.client_state == WebSocketState.CONNECTED:
-        await websocket.send_text(json.dumps({
-            "type": "show_document_upload"
-        }))
-        logger.info("Requested document upload from client")
+    await send_bot_events(websocket, [{"type": message_type, "text": text}])
 
 async def check_existing_payment(session_id: str, cookie_id: str = None, device_id: str = None) -> bool:
     """
     Check if a user has already completed payment based on various identifiers.
     Returns True if payment is completed, False otherwise.
     """
-    # Prepare identifier with all available IDs
-    identifier = {}
-    if session_id:
-        identifier["session_id"] = session_id
-    if cookie_id:
-        identifier["cookie_id"] = cookie_id
-    if device_id:
-        identifier["device_id"] = device_id
-    
     # If no identifiers, can't identify the user
-    if not identifier:
+    if not session_id and not cookie_id and not device_id:
         return False
     
-    # Check payment status for this user
-    if DB_AVAILABLE:
-        return UserProfile.has_completed_payment(identifier)
+    return await store.has_completed_payment(session_id, cookie_id, device_id)
+
+async def _handle_create_payment_link(session_id: str, events: List[Dict[str, Any]], tool_call: Dict[str, Any]):
+    """Generate a payment link after the agent called create_payment_link and queue it for the client."""
+    # Get customer info from tool arguments or database
+    customer_info = tool_call.get('arguments', {})
+    if not customer_info or not isinstance(customer_info, dict):
+        # Fallback to the stored profile
+        fields = (*CUSTOMER_INFO_FIELDS, "company_type")
+        user_data = await store.get(session_id, list(fields)) or {}
+        customer_info = {k: user_data[k] for k in fields if k in user_data}
+    
+    logger.info(f"Generating payment link with customer info: {customer_info}")
+    
+    # Generate payment link
+    payment_data = await asyncio.to_thread(generate_razorpay_link, customer_info)
+    
+    if payment_data["success"]:
+        # Store payment info in DB or memory
+        payment_data_to_store = {
+            "pending": True,
+            "payment_id": payment_data["payment_id"],
+            "link": payment_data["payment_link"],
+            "amount": payment_data["amount"],
+            "currency": payment_data["currency"]
+        }
+        
+        await store.update_payment(session_id, payment_data_to_store)
+        
+        # Send payment link to client (only popup, not in message)
+        events.append({"type": "payment_link", "link": payment_data["payment_link"]})
+        logger.info(f"Payment link queued for client: {payment_data['payment_link']}")
     else:
-        # Fallback to in-memory check
-        # First try by cookie ID
-        if cookie_id and cookie_id in payment_status:
-            return payment_status[cookie_id].get("completed", False)
+        logger.error(f"Failed to generate payment link: {payment_data.get('error', 'Unknown error')}")
+
+async def _handle_verify_payment_status(session_id: str, events: List[Dict[str, Any]], tool_call: Dict[str, Any]):
+    """
+    Refresh the stored payment status after the agent called verify_payment_status.
+    Razorpay is only asked when the stored status is not final and was not checked moments ago.
+    """
+    stored_payment = await store.get_payment(session_id)
+    
+    # Get payment ID from tool arguments or database
+    payment_id = None
+    if isinstance(tool_call.get('arguments'), dict):
+        payment_id = tool_call.get('arguments', {}).get('payment_id')
+    
+    if not payment_id:
+        # Fallback to the stored payment
+        payment_id = stored_payment.get("payment_id")
+    
+    if not payment_id:
+        logger.warning(f"No payment ID found for session {session_id}")
+        return
+    
+    if stored_payment.get("payment_id") == payment_id:
+        if stored_payment.get("completed") or stored_payment.get("status") in FINAL_PAYMENT_STATUSES:
+            logger.info(f"Payment {payment_id} already {stored_payment.get('status', 'completed')}, skipping Razorpay check")
+            return
         
-        # Then try by session ID
-        if session_id and session_id in payment_status:
-            return payment_status[session_id].get("completed", False)
+        checked_at = stored_payment.get("checked_at")
+        if checked_at and seconds_since(checked_at) < PAYMENT_RECHECK_SECONDS:
+            logger.info(f"Payment {payment_id} was checked {checked_at}, skipping Razorpay check")
+            return
+    
+    logger.info(f"Checking payment status for ID: {payment_id}")
+    
+    # Check payment status
+    payment_result = await asyncio.to_thread(check_payment_status, payment_id)
+    
+    if payment_result["success"]:
+        # Update payment status in DB or memory
+        # The payment ID is stored with the status so the next check can match it
+        payment_update = {
+            "payment_id": payment_id,
+            "status": payment_result["status"],
+            "checked_at": datetime.now(timezone.utc)
+        }
         
-        # Then try by device ID (not implemented in memory mode yet)
-        return False
+        if payment_result["payment_completed"]:
+            payment_update.update({
+                "pending": False,
+                "completed": True
+            })
+        
+        await store.update_payment(session_id, payment_update)
+        
+        logger.info(f"Updated payment status: {payment_update}")
+    else:
+        logger.error(f"Failed to check payment status: {payment_result.get('error', 'Unknown error')}")
+
+# Agent tool name -> handler run after the agent responds; handlers append any client events to the turn's list
+TOOL_HANDLERS: Dict[str, Callable[[str, List[Dict[str, Any]], Dict[str, Any]], Awaitable[None]]] = {
+    "create_payment_link": _handle_create_payment_link,
+    "verify_payment_status": _handle_verify_payment_status
+}
 
 async def process_message(session_id: str, message: str, websocket: WebSocket, cookie_id: str = None, device_id: str = None):
     """Process a user message using the appropriate agent."""
@@ -361,15 +654,12 @@ async def process_message(session_id: str, message: str, websocket: WebSocket, c
         identifier["device_id"] = device_id
     
     # Add to chat history
-    if DB_AVAILABLE:
-        # Add message to database
-        UserProfile.add_message_to_conversation(session_id, {"role": "user", "content": message})
-    else:
-        # Add to in-memory chat history
-        if session_id not in chat_histories:
-            chat_histories[session_id] = []
-        
-        chat_histories[session_id].append({"role": "user", "content": message})
+    await add_to_chat_history(session_id, {"role": "user", "content": message})
+    
+    # Events for the client are collected over the turn and sent together in one frame
+    events = []
+    # Profile fields learned during the turn are collected and written together
+    profile_updates: Dict[str, Any] = {}
     
     # Check if user has already completed payment
     payment_already_completed = await check_existing_payment(session_id, cookie_id, device_id)
@@ -377,18 +667,9 @@ async def process_message(session_id: str, message: str, websocket: WebSocket, c
     # Determine which agent to use based on conversation state
     agent_to_use = sales_agent  # Default to sales agent
     
-    # Get payment status (from DB or memory)
-    payment_pending = False
-    
-    if DB_AVAILABLE:
-        user_data = UserProfile.get_by_session(session_id)
-        if user_data:
-            if "payment" in user_data:
-                payment_pending = user_data["payment"].get("pending", False)
-    else:
-        # Use in-memory storage
-        if session_id in payment_status:
-            payment_pending = payment_status[session_id].get("pending", False)
+    # Get the session record and the last 5 messages in one read; the full conversation is never loaded here
+    user_data = await store.get(session_id, history_limit=5) or {}
+    payment_pending = user_data.get("payment", {}).get("pending", False)
     
     # If we're at the payment stage
     if payment_pending:
@@ -397,23 +678,15 @@ async def process_message(session_id: str, message: str, websocket: WebSocket, c
             # User already paid, no need to show payment page again
             logger.info(f"User has already completed payment in another session, skipping payment agent")
             # Move them out of payment_pending state
-            if DB_AVAILABLE:
-                UserProfile.update_payment_info(session_id, {"pending": False, "completed": True, "status": "completed"})
-            else:
-                if session_id in payment_status:
-                    payment_status[session_id]["pending"] = False
-                    payment_status[session_id]["completed"] = True
-                    payment_status[session_id]["status"] = "completed"
+            await store.update_payment(session_id, {"pending": False, "completed": True, "status": "completed"})
             
             # Send confirmation message
             already_paid_msg = "I see you've already completed the payment for your company registration. Great! Your registration is being processed, and our team will be in touch with you shortly with the next steps. Is there anything else you'd like to know about the process?"
-            await send_bot_message(websocket, already_paid_msg)
+            events.append({"type": "message", "text": already_paid_msg})
             
             # Add confirmation to chat history
-            if DB_AVAILABLE:
-                UserProfile.add_message_to_conversation(session_id, {"role": "assistant", "content": already_paid_msg})
-            else:
-                chat_histories[session_id].append({"role": "assistant", "content": already_paid_msg})
+            await add_to_chat_history(session_id, {"role": "assistant", "content": already_paid_msg})
+            user_data = await store.get(session_id, history_limit=5) or {}
                 
             # Continue as sales agent
             agent_to_use = sales_agent
@@ -427,356 +700,168 @@ async def process_message(session_id: str, message: str, websocket: WebSocket, c
     
     # Run the agent
     try:
-        # Prepare context from chat history with metadata if available
-        context_lines = []
+        # Prepare recent chat history with metadata if available (changes every turn)
+        history_lines = []
+        for m in user_data.get("conversation", []):
+            if "metadata" in m:
+                # Include metadata in a structured way, one line per key
+                history_lines.append(f"{m['role']} (with metadata):\nMessage: {m['content']}\nMetadata:")
+                history_lines.extend(f"  {k}: {v}" for k, v in m["metadata"].items())
+            else:
+                history_lines.append(f"{m['role']}: {m['content']}")
         
-        if DB_AVAILABLE:
-            user_data = UserProfile.get_by_session(session_id)
-            if user_data and "conversation" in user_data:
-                # Get the last 5 messages
-                recent_messages = user_data["conversation"][-5:] if len(user_data["conversation"]) > 5 else user_data["conversation"]
-                
-                for m in recent_messages:
-                    if "metadata" in m:
-                        # Include metadata in a structured way
-                        metadata_str = "\n".join([f"  {k}: {v}" for k, v in m["metadata"].items()])
-                        context_lines.append(f"{m['role']} (with metadata):\nMessage: {m['content']}\nMetadata:\n{metadata_str}")
-                    else:
-                        context_lines.append(f"{m['role']}: {m['content']}")
-                
-                # Add context summary if available
-                if "context_summary" in user_data:
-                    context_lines.append(f"Context Summary: {user_data['context_summary']}")
-        else:
-            # Use in-memory chat history
-            if session_id in chat_histories:
-                for m in chat_histories[session_id][-5:]:
-                    if "metadata" in m:
-                        # Include metadata in a structured way
-                        metadata_str = "\n".join([f"  {k}: {v}" for k, v in m["metadata"].items()])
-                        context_lines.append(f"{m['role']} (with metadata):\nMessage: {m['content']}\nMetadata:\n{metadata_str}")
-                    else:
-                        context_lines.append(f"{m['role']}: {m['content']}")
+        # Add context summary if available
+        if "context_summary" in user_data:
+            history_lines.insert(0, f"Context Summary: {user_data['context_summary']}")
         
-        context = "\n".join(context_lines)
+        history = "\n".join(history_lines)
         
-        # Add user info to context
-        if DB_AVAILABLE:
-            user_data = UserProfile.get_by_session(session_id)
-            if user_data:
-                # Extract user info from user_data
-                user_info_data = {k: v for k, v in user_data.items() if k not in ["conversation", "document", "payment", "context_summary"]}
-                if user_info_data:
-                    # Convert MongoDB data to JSON serializable format
-                    serializable_data = mongo_to_json_serializable(user_info_data)
-                    context += f"\nUser info: {json.dumps(serializable_data)}"
-                
-                # Add payment status
-                if "payment" in user_data:
-                    # Convert MongoDB data to JSON serializable format
-                    serializable_payment = mongo_to_json_serializable(user_data['payment'])
-                    context += f"\nPayment status: {json.dumps(serializable_payment)}"
-        else:
-            # Use in-memory storage
-            if session_id in user_info:
-                context += f"\nUser info: {json.dumps(user_info[session_id])}"
-                
-            if session_id in payment_status:
-                context += f"\nPayment status: {json.dumps(payment_status[session_id])}"
+        # Prepare the user profile (stable across turns); keys are sorted so the text is identical turn to turn
+        profile_lines = []
+        
+        # Extract user info from user_data, leaving out per-turn fields
+        user_info_data = {k: v for k, v in user_data.items() if k not in VOLATILE_USER_FIELDS}
+        if user_info_data:
+            profile_lines.append(f"User info: {json_dumps(user_info_data, sort_keys=True)}")
+        
+        # Add payment status
+        if "payment" in user_data:
+            profile_lines.append(f"Payment status: {json_dumps(user_data['payment'], sort_keys=True)}")
+        
+        profile = "\n".join(profile_lines)
         
         # Create the prompt with agent-specific instructions
         agent_type = "sales"
         if payment_pending:
             agent_type = "payment"
         
-        # Determine language preference from conversation or user data
-        language_preference = "English"
-        hinglish_indicators = ["मैं", "हमें", "मेरा", "आप", "कैसे", "क्या", "नहीं", "है", "करना", "चाहिए"]
-        
-        # Check for Hinglish in current message
-        if any(hindi_word in message.lower() for hindi_word in hinglish_indicators):
-            language_preference = "Hinglish"
-        # Otherwise check in user data if available
-        elif DB_AVAILABLE:
-            user_data = UserProfile.get_by_session(session_id)
-            if user_data and "short_context" in user_data and "Lang: Hinglish" in user_data["short_context"]:
+        # Use the language stored on the session once it is known, so the message is only scanned until then
+        language_preference = user_data.get("language")
+        if not language_preference:
+            if HINGLISH_RE.search(message):
                 language_preference = "Hinglish"
+                profile_updates["language"] = language_preference
+            else:
+                language_preference = "English"
+                english_turns = user_data.get("english_turns", 0) + 1
+                if english_turns >= ENGLISH_TURNS_TO_CONFIRM:
+                    profile_updates["language"] = language_preference
+                else:
+                    profile_updates["english_turns"] = english_turns
             
         # Prepare tool parameters for payment agent
         tool_params = {}
         
         # For payment agent, include payment info
         if agent_type == "payment":
-            if DB_AVAILABLE:
-                user_data = UserProfile.get_by_session(session_id)
-                if user_data and "payment" in user_data:
-                    payment_info = user_data["payment"]
-                    if "payment_id" in payment_info:
-                        tool_params["payment_id"] = payment_info["payment_id"]
-                    if "link" in payment_info:
-                        tool_params["payment_link"] = payment_info["link"]
-            else:
-                # Use in-memory storage
-                if session_id in payment_status:
-                    payment_info = payment_status[session_id]
-                    if "payment_id" in payment_info:
-                        tool_params["payment_id"] = payment_info["payment_id"]
-                    if "link" in payment_info:
-                        tool_params["payment_link"] = payment_info["link"]
+            payment_info = user_data.get("payment", {})
+            if "payment_id" in payment_info:
+                tool_params["payment_id"] = payment_info["payment_id"]
+            if "link" in payment_info:
+                tool_params["payment_link"] = payment_info["link"]
         
         # Get or create thread ID for this session
-        thread_id = None
-        if DB_AVAILABLE:
-            user_data = UserProfile.get_by_session(session_id)
-            if user_data and "thread_id" in user_data:
-                thread_id = user_data["thread_id"]
-                logger.info(f"Using existing thread ID from database: {thread_id}")
-            else:
-                # Generate a new thread ID for this user
-                thread_id = f"thread_{session_id}"
-                # Store in database
-                UserProfile.create_or_update(session_id, {"thread_id": thread_id})
-                logger.info(f"Created new thread ID in database: {thread_id}")
+        thread_id = user_data.get("thread_id")
+        if thread_id:
+            logger.info(f"Using existing thread ID: {thread_id}")
         else:
-            # Use in-memory storage
-            if session_id in thread_ids:
-                thread_id = thread_ids[session_id]
-                logger.info(f"Using existing thread ID from memory: {thread_id}")
-            else:
-                # Generate a new thread ID for this user
-                thread_id = f"thread_{session_id}"
-                thread_ids[session_id] = thread_id
-                logger.info(f"Created new thread ID in memory: {thread_id}")
-        
-        # Create the prompt with language preference and session ID
-        prompt = f"""Context:
-{context}
-
-User's latest message: {message}
-
-Session ID: {session_id}
-Thread ID: {thread_id}
-
-Respond as a {agent_type} agent.
-Language preference: {language_preference}.
-If language preference is Hinglish, respond in conversational Hindi-English mixed language, using a natural and friendly tone like a human CA would speak to a client from North India.
-"""
-        
-        # Run the agent with tool parameters if available
-        logger.info(f"Running {agent_type} agent for session: {session_id} (thread ID: {thread_id})")
-        if tool_params:
-            logger.info(f"Including tool parameters: {tool_params}")
-            result = await Runner.run(agent_to_use, input=prompt, tool_params=tool_params)
+            # Generate a new thread ID for this user
+            thread_id = f"thread_{session_id}"
+            profile_updates["thread_id"] = thread_id
+            logger.info(f"Created new thread ID: {thread_id}")
+        
+        # Create the prompt with the static instructions and session details first and the
+        # per-turn history and latest message last, so the prompt prefix stays cacheable by the LLM provider
+        prompt_parts = (
+            PROMPT_PREFIX[(agent_type, language_preference)],
+            f"Session ID: {session_id}\nThread ID: {thread_id}\n{profile}\n\n",
+            f"Recent history:\n{history}\n\nUser's latest message: {message}\n"
+        )
+        prompt = "".join(prompt_parts)
+        
+        # Only opening questions from visitors who have not given their name are served from the response cache:
+        # the answer depends on nothing but the agent, the language and the message, so it repeats across sessions
+        cache_key = None
+        if (agent_type == "sales" and len(user_data.get("conversation", [])) <= 1
+                and not user_data.get("context_summary") and not user_data.get("name")):
+            cache_key = llm_cache.cache_key(agent_to_use.name, message, language=language_preference)
+        cached = await llm_cache.get(cache_key) if cache_key else None
+        
+        if cached:
+            result = None
+            response = cached["text"]
+            logger.info(f"Using cached {agent_type} agent response for session: {session_id}")
         else:
-            result = await Runner.run(agent_to_use, input=prompt)
+            # Run the agent with tool parameters if available
+            logger.info(f"Running {agent_type} agent for session: {session_id} (thread ID: {thread_id})")
+            if tool_params:
+                logger.info(f"Including tool parameters: {tool_params}")
+                result = await Runner.run(agent_to_use, input=prompt, tool_params=tool_params)
+            else:
+                result = await Runner.run(agent_to_use, input=prompt)
+                
+            response = result.final_output
             
-        response = result.final_output
+            if cache_key and result_is_cacheable(result):
+                await llm_cache.set(cache_key, {"text": response})
+        
         logger.info(f"Agent response: {response[:100]}...")
         
         # Add to chat history
-        if DB_AVAILABLE:
-            UserProfile.add_message_to_conversation(session_id, {"role": "assistant", "content": response})
-        else:
-            # Add to in-memory chat history
-            chat_histories[session_id].append({"role": "assistant", "content": response})
-        
-        # Send response to client
-        await send_bot_message(websocket, response)
+        message_count = await add_to_chat_history(session_id, {"role": "assistant", "content": response})
         
-        # Check if the agent used any tools
-        payment_link_requested = False
-        payment_status_check_requested = False
+        # Queue the response for the client
+        events.append({"type": "message", "text": response})
         
-        # Extract tool call information from the result's extra info
+        # Dispatch any tools the agent called to their handlers
         if hasattr(result, 'extra_info') and isinstance(result.extra_info, dict):
             tools_called = result.extra_info.get('tools_called', [])
             
-            # Check which tools were called
             if isinstance(tools_called, list):
+                # A tool repeated with the same arguments in one run is only handled once
+                handled_calls = set()
                 for tool_call in tools_called:
                     if isinstance(tool_call, dict):
-                        # Payment link generation tool
-                        if tool_call.get('name') == 'create_payment_link':
-                            payment_link_requested = True
-                            
-                            # Get customer info from tool arguments or database
-                            customer_info = tool_call.get('arguments', {})
-                            if not customer_info or not isinstance(customer_info, dict):
-                                # Fallback to database or memory
-                                if DB_AVAILABLE:
-                                    user_data = UserProfile.get_by_session(session_id)
-                                    if user_data:
-                                        customer_info = {k: v for k, v in user_data.items() if k in ["name", "email", "phone", "company_type"]}
-                                else:
-                                    customer_info = user_info.get(session_id, {})
-                            
-                            logger.info(f"Generating payment link with customer info: {customer_info}")
-                            
-                            # Generate payment link
-                            payment_data = generate_razorpay_link(customer_info)
-                            
-                            if payment_data["success"]:
-                                # Store payment info in DB or memory
-                                payment_data_to_store = {
-                                    "pending": True,
-                                    "payment_id": payment_data["payment_id"],
-                                    "link": payment_data["payment_link"],
-                                    "amount": payment_data["amount"],
-                                    "currency": payment_data["currency"]
-                                }
-                                
-                                if DB_AVAILABLE:
-                                    UserProfile.update_payment_info(session_id, payment_data_to_store)
-                                else:
-                                    payment_status[session_id] = payment_data_to_store
-                                
-                                # Send payment link to client (only popup, not in message)
-                                await send_payment_link(websocket, payment_data["payment_link"])
-                                logger.info(f"Payment link sent to client: {payment_data['payment_link']}")
-                            else:
-                                logger.error(f"Failed to generate payment link: {payment_data.get('error', 'Unknown error')}")
+                        call_key = (tool_call.get('name'), json_dumps(tool_call.get('arguments'), sort_keys=True))
+                        if call_key in handled_calls:
+                            continue
+                        handled_calls.add(call_key)
                         
-                        # Payment status check tool
-                        elif tool_call.get('name') == 'verify_payment_status':
-                            payment_status_check_requested = True
-                            
-                            # Get payment ID from tool arguments or database
-                            payment_id = None
-                            if isinstance(tool_call.get('arguments'), dict):
-                                payment_id = tool_call.get('arguments', {}).get('payment_id')
-                            
-                            if not payment_id:
-                                # Fallback to database or memory
-                                if DB_AVAILABLE:
-                                    user_data = UserProfile.get_by_session(session_id)
-                                    if user_data and "payment" in user_data:
-                                        payment_id = user_data["payment"].get("payment_id")
-                                else:
-                                    if session_id in payment_status:
-                                        payment_id = payment_status[session_id].get("payment_id")
-                            
-                            if payment_id:
-                                logger.info(f"Checking payment status for ID: {payment_id}")
-                                
-                                # Check payment status
-                                payment_result = check_payment_status(payment_id)
-                                
-                                if payment_result["success"]:
-                                    # Update payment status in DB or memory
-                                    payment_update = {
-                                        "status": payment_result["status"],
-                                        "checked_at": datetime.now().isoformat()
-                                    }
-                                    
-                                    if payment_result["payment_completed"]:
-                                        payment_update.update({
-                                            "pending": False,
-                                            "completed": True
-                                        })
-                                    
-                                    if DB_AVAILABLE:
-                                        UserProfile.update_payment_info(session_id, payment_update)
-                                    else:
-                                        if session_id in payment_status:
-                                            payment_status[session_id].update(payment_update)
-                                    
-                                    logger.info(f"Updated payment status: {payment_update}")
-                                else:
-                                    logger.error(f"Failed to check payment status: {payment_result.get('error', 'Unknown error')}")
-                            else:
-                                logger.warning(f"No payment ID found for session {session_id}")
+                        handler = TOOL_HANDLERS.get(tool_call.get('name'))
+                        if handler:
+                            await handler(session_id, events, tool_call)
+        
+        # Send the response and any tool-triggered events to the client
+        await send_bot_events(websocket, events)
+        events = []
         
         # Extract and store user info if detected in the conversation
         # This is a simple heuristic approach for the MVP
-        if "my name is" in message.lower() or "i am" in message.lower():
-            # Try to extract a name
-            import re
-            name_patterns = [
-                r"my name is\s+([A-Z][a-z]+(?:\s+[A-Z][a-z]+)*)",
-                r"I am\s+([A-Z][a-z]+(?:\s+[A-Z][a-z]+)*)",
-                r"this is\s+([A-Z][a-z]+(?:\s+[A-Z][a-z]+)*)"
-            ]
-            
-            for pattern in name_patterns:
-                name_match = re.search(pattern, message, re.IGNORECASE)
-                if name_match:
-                    name = name_match.group(1)
-                    
-                    # Store in DB or memory
-                    if DB_AVAILABLE:
-                        UserProfile.create_or_update(session_id, {"name": name})
-                    else:
-                        if session_id not in user_info:
-                            user_info[session_id] = {}
-                        user_info[session_id]["name"] = name
-                        
-                    logger.info(f"Extracted name for session {session_id}: {name}")
-                    break
-        
-        # Try to extract email
-        if "@" in message and "." in message:
-            import re
-            email_pattern = r'[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}'
-            email_match = re.search(email_pattern, message)
-            if email_match:
-                email = email_match.group(0)
-                
-                # Store in DB or memory
-                if DB_AVAILABLE:
-                    UserProfile.create_or_update(session_id, {"email": email})
-                else:
-                    if session_id not in user_info:
-                        user_info[session_id] = {}
-                    user_info[session_id]["email"] = email
-                    
-                logger.info(f"Extracted email for session {session_id}: {email}")
+        for field, value in extract_contact_details(message).items():
+            profile_updates[field] = value
+            logger.info(f"Extracted {field} for session {session_id}: {value}")
         
-        # Try to extract phone number (simple pattern for Indian numbers)
-        if any(digit in message for digit in "0123456789"):
-            import re
-            phone_patterns = [
-                r'\+91[0-9]{10}',
-                r'[6-9][0-9]{9}'
-            ]
-            
-            for pattern in phone_patterns:
-                phone_match = re.search(pattern, message)
-                if phone_match:
-                    phone = phone_match.group(0)
-                    
-                    # Store in DB or memory
-                    if DB_AVAILABLE:
-                        UserProfile.create_or_update(session_id, {"phone": phone})
-                    else:
-                        if session_id not in user_info:
-                            user_info[session_id] = {}
-                        user_info[session_id]["phone"] = phone
-                        
-                    logger.info(f"Extracted phone for session {session_id}: {phone}")
-                    break
+        # Store everything learned about the user this turn in one write
+        if profile_updates:
+            await store.update_user(session_id, profile_updates)
         
-        # After every 5 messages, generate and update context summary
-        if DB_AVAILABLE:
-            user_data = UserProfile.get_by_session(session_id)
-            if user_data and "conversation" in user_data:
-                if len(user_data["conversation"]) % 5 == 0:
-                    # Generate and store context summary
-                    context_data = await generate_context_summary(session_id)
-                    UserProfile.update_context_summary(
-                        session_id,
-                        context_data["summary"],
-                        context_data["short_context"]
-                    )
-                    logger.info(f"Updated context summary for session {session_id}")
+        # After every 5 messages, update the context summary without holding up the turn
+        if message_count and message_count % 5 == 0:
+            schedule_context_summary(session_id)
         
     except Exception as e:
         logger.error(f"Error processing message: {str(e)}", exc_info=True)
-        await send_bot_message(websocket, "I'm having trouble processing your request. Please try again.")
+        events.append({"type": "message", "text": "I'm having trouble processing your request. Please try again."})
+        await send_bot_events(websocket, events)
 
 async def handle_inactivity(session_id: str, websocket: WebSocket, context: Optional[str] = None, cookie_id: str = None, device_id: str = None):
     """Handle user inactivity with AI-generated follow-ups based on conversation context."""
     logger.info(f"Handling inactivity for session {session_id}")
     
+    # Nobody is left to follow up with, so skip the lookups and the agent run
+    if not is_connected(websocket):
+        return
+    
     # Get user identifier
     identifier = {"session_id": session_id}
     if cookie_id:
@@ -784,37 +869,20 @@ async def handle_inactivity(session_id: str, websocket: WebSocket, context: Opti
     if device_id:
         identifier["device_id"] = device_id
     
-    # Check if user exists
-    if DB_AVAILABLE:
-        user_data = UserProfile.find_user(identifier)
-        if not user_data or "conversation" not in user_data or not user_data["conversation"]:
-            logger.info(f"No conversation history for session {session_id}, cannot generate follow-up")
-            return
-    else:
-        if session_id not in chat_histories or not chat_histories[session_id]:
-            logger.info(f"No in-memory conversation history for session {session_id}")
-            return
+    # Fetch the session record and its recent history once; everything below reads from it
+    user_data = await store.get(session_id, history_limit=5) or {}
+    recent_messages = user_data.get("conversation", [])
+    if not recent_messages:
+        logger.info(f"No conversation history for session {session_id}, cannot generate follow-up")
+        return
     
     # Determine which agent to use based on conversation state
     agent_to_use = sales_agent  # Default to sales agent
     agent_type = "sales"
     
-    # Get document and payment status from DB or memory
-    doc_pending = False
-    payment_pending = False
-    
-    if DB_AVAILABLE:
-        user_data = UserProfile.get_by_session(session_id)
-        if user_data:
-            if "document" in user_data:
-                doc_pending = user_data["document"].get("pending", False)
-            if "payment" in user_data:
-                payment_pending = user_data["payment"].get("pending", False)
-    else:
-        if session_id in document_status:
-            doc_pending = document_status[session_id].get("pending", False)
-        if session_id in payment_status:
-            payment_pending = payment_status[session_id].get("pending", False)
+    # Get document and payment status
+    doc_pending = user_data.get("document", {}).get("pending", False)
+    payment_pending = user_data.get("payment", {}).get("pending", False)
     
     # If we're at the document verification stage
     if doc_pending:
@@ -826,68 +894,38 @@ async def handle_inactivity(session_id: str, websocket: WebSocket, context: Opti
         agent_to_use = payment_agent
         agent_type = "payment"
     
+    # Early in a sales conversation there is little for the agent to work with, so skip the LLM round-trip
+    if agent_type == "sales" and context != "payment_pending" and len(recent_messages) <= INACTIVITY_TEMPLATE_MAX_MESSAGES:
+        follow_ups = INACTIVITY_FOLLOW_UPS.get(user_data.get("language"), INACTIVITY_FOLLOW_UPS["English"])
+        follow_up_message = follow_ups[hash(session_id) % len(follow_ups)]
+        
+        await add_to_chat_history(session_id, {
+            "role": "assistant",
+            "content": follow_up_message,
+            "metadata": {"type": "inactivity_follow_up", "context": context or "general"}
+        })
+        await send_bot_message(websocket, follow_up_message, "follow_up")
+        return
+    
     try:
         # Prepare context from chat history
         context_lines = []
+        for m in recent_messages:
+            if "metadata" in m:
+                # Include metadata in a structured way, one line per key
+                context_lines.append(f"{m['role']} (with metadata):\nMessage: {m['content']}\nMetadata:")
+                context_lines.extend(f"  {k}: {v}" for k, v in m["metadata"].items())
+            else:
+                context_lines.append(f"{m['role']}: {m['content']}")
         
-        if DB_AVAILABLE:
-            user_data = UserProfile.get_by_session(session_id)
-            if user_data and "conversation" in user_data:
-                recent_messages = user_data["conversation"][-5:] if len(user_data["conversation"]) > 5 else user_data["conversation"]
-                
-                for m in recent_messages:
-                    if "metadata" in m:
-                        # Include metadata in a structured way
-                        metadata_str = "\n".join([f"  {k}: {v}" for k, v in m["metadata"].items()])
-                        context_lines.append(f"{m['role']} (with metadata):\nMessage: {m['content']}\nMetadata:\n{metadata_str}")
-                    else:
-                        context_lines.append(f"{m['role']}: {m['content']}")
-                
-                # Add context summary if available
-                if "context_summary" in user_data:
-                    context_lines.append(f"Context Summary: {user_data['context_summary']}")
-        else:
-            for m in chat_histories[session_id][-5:]:
-                if "metadata" in m:
-                    # Include metadata in a structured way
-                    metadata_str = "\n".join([f"  {k}: {v}" for k, v in m["metadata"].items()])
-                    context_lines.append(f"{m['role']} (with metadata):\nMessage: {m['content']}\nMetadata:\n{metadata_str}")
-                else:
-                    context_lines.append(f"{m['role']}: {m['content']}")
+        # Add context summary if available
+        if "context_summary" in user_data:
+            context_lines.append(f"Context Summary: {user_data['context_summary']}")
         
         conversation_context = "\n".join(context_lines)
         
         # Add user info, document status, payment status
-        if DB_AVAILABLE:
-            user_data = UserProfile.get_by_session(session_id)
-            if user_data:
-                # Extract user info
-                user_info_data = {k: v for k, v in user_data.items() if k not in ["conversation", "document", "payment", "context_summary"]}
-                if user_info_data:
-                    # Convert MongoDB data to JSON serializable format
-                    serializable_data = mongo_to_json_serializable(user_info_data)
-                    conversation_context += f"\nUser info: {json.dumps(serializable_data)}"
-                
-                # Add document status
-                if "document" in user_data:
-                    # Convert MongoDB data to JSON serializable format
-                    serializable_doc = mongo_to_json_serializable(user_data['document'])
-                    conversation_context += f"\nDocument status: {json.dumps(serializable_doc)}"
-                
-                # Add payment status
-                if "payment" in user_data:
-                    # Convert MongoDB data to JSON serializable format
-                    serializable_payment = mongo_to_json_serializable(user_data['payment'])
-                    conversation_context += f"\nPayment status: {json.dumps(serializable_payment)}"
-        else:
-            if session_id in user_info:
-                conversation_context += f"\nUser info: {json.dumps(user_info[session_id])}"
-            
-            if session_id in document_status:
-                conversation_context += f"\nDocument status: {json.dumps(document_status[session_id])}"
-                
-            if session_id in payment_status:
-                conversation_context += f"\nPayment status: {json.dumps(payment_status[session_id])}"
+        conversation_context += serialize_user_blocks(session_id, user_data)
         
         # Special context information for specific scenarios
         additional_context = ""
@@ -899,28 +937,14 @@ async def handle_inactivity(session_id: str, websocket: WebSocket, context: Opti
         
         
         # Get thread ID for this session - ensure we use the same thread for follow-ups
-        thread_id = None
-        if DB_AVAILABLE:
-            user_data = UserProfile.get_by_session(session_id)
-            if user_data and "thread_id" in user_data:
-                thread_id = user_data["thread_id"]
-                logger.info(f"Using existing thread ID for follow-up: {thread_id}")
-            else:
-                # Generate a new thread ID if for some reason we don't have one
-                thread_id = f"thread_{session_id}"
-                # Store in database
-                UserProfile.create_or_update(session_id, {"thread_id": thread_id})
-                logger.info(f"Created new thread ID for follow-up: {thread_id}")
+        thread_id = user_data.get("thread_id")
+        if thread_id:
+            logger.info(f"Using existing thread ID for follow-up: {thread_id}")
         else:
-            # Use in-memory storage
-            if session_id in thread_ids:
-                thread_id = thread_ids[session_id]
-                logger.info(f"Using existing thread ID for follow-up: {thread_id}")
-            else:
-                # Generate a new thread ID if for some reason we don't have one
-                thread_id = f"thread_{session_id}"
-                thread_ids[session_id] = thread_id
-                logger.info(f"Created new thread ID for follow-up: {thread_id}")
+            # Generate a new thread ID if for some reason we don't have one
+            thread_id = f"thread_{session_id}"
+            await store.update_user(session_id, {"thread_id": thread_id})
+            logger.info(f"Created new thread ID for follow-up: {thread_id}")
         
         # Create the inactivity prompt
         inactivity_prompt = f"""
@@ -955,25 +979,14 @@ Your follow-up message:
         logger.info(f"AI-generated follow-up: {follow_up_message[:50]}...")
         
         # Add to chat history
-        if DB_AVAILABLE:
-            UserProfile.add_message_to_conversation(
-                session_id, 
-                {
-                    "role": "assistant",
-                    "content": follow_up_message,
-                    "metadata": {"type": "inactivity_follow_up", "context": context or "general"}
-                }
-            )
-        else:
-            chat_histories[session_id].append({
-                "role": "assistant",
-                "content": follow_up_message,
-                "metadata": {"type": "inactivity_follow_up", "context": context or "general"}
-            })
+        await add_to_chat_history(session_id, {
+            "role": "assistant",
+            "content": follow_up_message,
+            "metadata": {"type": "inactivity_follow_up", "context": context or "general"}
+        })
         
         # Send follow-up message
-        if websocket.client_state == WebSocketState.CONNECTED:
-            await send_bot_message(websocket, follow_up_message, "follow_up")
+        await send_bot_message(websocket, follow_up_message, "follow_up")
             
     except Exception as e:
         logger.error(f"Error generating inactivity follow-up: {str(e)}", exc_info=True)
@@ -992,6 +1005,10 @@ async def websocket_endpoint(websocket: WebSocket):
     """WebSocket endpoint for chat communication."""
     await websocket.accept()
     
+    # All outbound events for this connection go through a queue drained by a dedicated writer task
+    websocket.state.out_queue = asyncio.Queue(maxsize=256)
+    writer_task = asyncio.create_task(connection_writer(websocket, websocket.state.out_queue))
+    
     # Generate a session ID for this connection
     session_id = str(uuid.uuid4())
     active_connections[session_id] = websocket
@@ -1001,28 +1018,37 @@ async def websocket_endpoint(websocket: WebSocket):
     cookie_id = None
     device_id = None
     user_identified = False
+    # Identifiers only arrive before and with the first message; later frames skip the bookkeeping
+    handshake_done = False
     
     try:
         # Send session ID to client on connection
-        await websocket.send_text(json.dumps({
+        await send_bot_events(websocket, [{
             "type": "session_info",
             "session_id": session_id,
             "requires_cookie": True,  # Tell client we need a cookie
             "requires_device_id": True  # Tell client we need device fingerprint
-        }))
+        }])
         logger.info(f"Sent session ID to client and requested identifiers: {session_id}")
         
         while True:
-            data = await websocket.receive_text()
-            data_json = json.loads(data)
+            # Frames are parsed straight from whichever payload arrived; binary frames skip the UTF-8 decode
+            frame = await websocket.receive()
+            if frame["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(frame.get("code", 1000))
+            data_json = orjson.loads(frame.get("bytes") or frame["text"])
+            
+            # Identifiers and profile data from this frame are written together in one update
+            frame_identifiers: Dict[str, Any] = {}
+            frame_updates: Dict[str, Any] = {}
             
             # Handle identifiers from client
-            if "cookie_id" in data_json:
+            if not handshake_done and "cookie_id" in data_json:
                 cookie_id = data_json["cookie_id"]
                 logger.info(f"Received cookie ID: {cookie_id}")
             
             # Handle device ID
-            if "device_id" in data_json:
+            if not handshake_done and "device_id" in data_json:
                 device_id = data_json["device_id"]
                 logger.info(f"Received device ID: {device_id}")
                 
@@ -1046,22 +1072,19 @@ async def websocket_endpoint(websocket: WebSocket):
                     if not cookie_id:
                         # Generate a new cookie ID
                         cookie_id = f"cookie_{str(uuid.uuid4())}"
-                        await websocket.send_text(json.dumps({
+                        await send_bot_events(websocket, [{
                             "type": "set_cookie",
                             "cookie_id": cookie_id
-                        }))
+                        }])
                         identifiers["cookie_id"] = cookie_id
                         logger.info(f"Sent new cookie ID to client: {cookie_id}")
                     
                     # Check if user exists with any of the identifiers
-                    existing_user = UserProfile.find_user(identifiers)
+                    existing_user = await asyncio.to_thread(UserProfile.find_user, identifiers, {"name": 1})
                     if existing_user:
                         # Update the existing user with this new session and all identifiers
                         user_identified = True
-                        UserProfile.create_or_update_user(
-                            identifiers,
-                            {"last_active": datetime.now().isoformat()}
-                        )
+                        frame_identifiers.update(identifiers)
                         
                         # Check if this user has already completed payment
                         payment_completed = await check_existing_payment(session_id, cookie_id, device_id)
@@ -1082,25 +1105,19 @@ async def websocket_endpoint(websocket: WebSocket):
                         logger.info(f"Welcomed returning user with identifiers: {identifiers}")
                     else:
                         # Create a new user profile with all identifiers
-                        UserProfile.create_or_update_user(
-                            identifiers,
-                            {
-                                "created_at": datetime.now().isoformat(),
-                                "last_active": datetime.now().isoformat()
-                            }
-                        )
-                        logger.info(f"Created new user profile with identifiers: {identifiers}")
+                        frame_identifiers.update(identifiers)
+                        logger.info(f"Creating new user profile with identifiers: {identifiers}")
             
             # Check if a previous session_id is provided (for reconnects)
-            if "previous_session_id" in data_json:
+            if not handshake_done and "previous_session_id" in data_json:
                 previous_session_id = data_json["previous_session_id"]
                 
                 if DB_AVAILABLE:
                     # Check if session exists in DB
-                    user_data = UserProfile.get_by_session(previous_session_id)
+                    user_data = await asyncio.to_thread(UserProfile.get_fields, previous_session_id, {"_id": 1})
                     if user_data:
                         # Link the new session to the existing user
-                        UserProfile.create_or_update_user(
+                        await asyncio.to_thread(UserProfile.create_or_update_user,
                             {"session_id": previous_session_id},
                             {"sessions": [session_id]}
                         )
@@ -1108,13 +1125,13 @@ async def websocket_endpoint(websocket: WebSocket):
                         logger.info(f"Reconnected session from DB: previous={previous_session_id}, current={session_id}")
                 else:
                     # In-memory data handling
-                    if previous_session_id in chat_histories:
+                    if previous_session_id in sessions:
                         # Just update the active connection mapping
                         active_connections[session_id] = websocket
                         logger.info(f"Reconnected session: {previous_session_id} -> {session_id}")
             
             # Handle client info (device, user details)
-            if "client_info" in data_json:
+            if not handshake_done and "client_info" in data_json:
                 client_info = data_json["client_info"]
                 
                 # We have several possible identifiers in client_info
@@ -1149,22 +1166,24 @@ async def websocket_endpoint(websocket: WebSocket):
                         logger.info(f"User identified with contact info for session {session_id}")
                     
                     # Create or update user with available info
-                    UserProfile.create_or_update_user(identifiers, user_data)
+                    frame_identifiers.update(identifiers)
+                    frame_updates.update(user_data)
+            
+            # Messages update the last active timestamp, by cookie_id if available, otherwise session_id
+            # Bursts of messages only write it once per LAST_ACTIVE_INTERVAL
+            if data_json["type"] == "message" and DB_AVAILABLE and last_active_due(session_id):
+                frame_identifiers["session_id"] = session_id
+                if cookie_id:
+                    frame_identifiers["cookie_id"] = cookie_id
+            
+            # create_or_update_user creates the user if needed and always sets last_active
+            if frame_identifiers:
+                await asyncio.to_thread(UserProfile.create_or_update_user, frame_identifiers, frame_updates)
+                last_active_written[session_id] = time.monotonic()
             
             # Process messages
             if data_json["type"] == "message":
-                # Update last active timestamp
-                if DB_AVAILABLE:
-                    # Use cookie_id if available, otherwise session_id
-                    identifier = {"session_id": session_id}
-                    if cookie_id:
-                        identifier["cookie_id"] = cookie_id
-                    
-                    # Update last active timestamp
-                    UserProfile.create_or_update_user(
-                        identifier,
-                        {"last_active": datetime.now().isoformat()}
-                    )
+                handshake_done = True
                 
                 # Process user message with all available identifiers
                 await process_message(session_id, data_json["text"], websocket, cookie_id, device_id)
@@ -1174,96 +1193,198 @@ async def websocket_endpoint(websocket: WebSocket):
                 await handle_inactivity(session_id, websocket, context, cookie_id, device_id)
     except WebSocketDisconnect:
         logger.info(f"WebSocket disconnected: {session_id}")
-        if session_id in active_connections:
-            del active_connections[session_id]
     except Exception as e:
         logger.error(f"WebSocket error: {str(e)}", exc_info=True)
-        if session_id in active_connections:
-            del active_connections[session_id]
+    finally:
+        # Cleanup runs on every exit, including task cancellation when the server shuts down
+        active_connections.pop(session_id, None)
+        writer_task.cancel()
+        last_active_written.pop(session_id, None)
+        inactivity_blocks.pop(session_id, None)
 
-@app.post("/upload-document")
-async def upload_document(
-    document: UploadFile = File(...),
-    session_id: str = Form(...),
-    cookie_id: str = Form(None),
-    device_id: str = Form(None)
-):
-    """Handle document upload."""
-    logger.info(f"Document upload requested for session {session_id}: {document.filename}")
+async def find_request_user(session_id: str, cookie_id: Optional[str] = None, device_id: Optional[str] = None,
+                            projection: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+    """
+    Find the user behind an HTTP request - try device ID first, then cookie, then session.
+    A request with only a session ID is a plain session lookup, so it goes through the per-session read cache.
+    """
+    if not device_id and not cookie_id:
+        return await asyncio.to_thread(UserProfile.get_fields, session_id, projection)
     
-    # Identify user - try device ID first, then cookie, then session
-    user = None
-    actual_session_id = session_id
+    identifiers = {}
+    
+    # Device ID is the strongest identifier
+    if device_id:
+        identifiers["device_id"] = device_id
+    
+    # Use cookie ID if provided
+    if cookie_id:
+        identifiers["cookie_id"] = cookie_id
     
+    # Always include session ID as a fallback
+    identifiers["session_id"] = session_id
+    
+    return await asyncio.to_thread(UserProfile.find_user, identifiers, projection)
+
+def simulate_document_verification() -> Dict[str, Any]:
+    """Stand in for the vision check when no OpenAI key is set; about 20% of documents are rejected."""
+    if random.random() < 0.8:
+        return {
+            "is_valid": True,
+            "analysis": "Document appears to be valid (simulated).",
+            "next_steps": "proceed_to_payment"
+        }
+    return {
+        "is_valid": False,
+        "analysis": "The document appears to be unclear or invalid. This appears to be a screenshot rather than a proper identity document.",
+        "next_steps": "request_new_document"
+    }
+
+async def _on_document_verified(websocket: WebSocket, session_id: str, verification_data: Dict[str, Any]):
+    """
+    Tell a connected user their document was approved and send the payment link.
+    The verification is stored here, in the same write as the payment link and its message.
+    """
+    events = [{
+        "type": "message",
+        "text": "Thank you! I've verified your document and everything looks good. We can now proceed with the registration process."
+    }]
+    
+    # If document is valid, transition to payment step
+    # Generate and send payment link
+    user_data = None
     if DB_AVAILABLE:
-        identifiers = {}
-        
-        # Use device ID if provided (strongest identifier)
-        if device_id:
-            identifiers["device_id"] = device_id
-            
-        # Use cookie ID if provided
-        if cookie_id:
-            identifiers["cookie_id"] = cookie_id
+        user_data = await asyncio.to_thread(UserProfile.get_fields, session_id, {k: 1 for k in CUSTOMER_INFO_FIELDS})
+    
+    if user_data:
+        customer_info = {k: user_data[k] for k in CUSTOMER_INFO_FIELDS if k in user_data}
+    else:
+        session = sessions.get(session_id)
+        customer_info = session.user if session else {}
+        if not customer_info:
+            customer_info = {"name": "Customer", "email": f"customer_{session_id[:8]}@example.com"}
+    
+    payment_data = await asyncio.to_thread(generate_razorpay_link, customer_info)
+    
+    payment_data_to_store = None
+    payment_chat_message = None
+    if payment_data["success"]:
+        # Store payment info in DB or memory
+        payment_data_to_store = {
+            "pending": True,
+            "link": payment_data["payment_link"],
+            "amount": payment_data["amount"],
+            "currency": payment_data["currency"]
+        }
         
-        # Always include session ID as a fallback
-        identifiers["session_id"] = session_id
+        # Send payment link message
+        payment_message = f"Great news! Your document has been verified and approved. To proceed with your company registration, please complete the payment of {payment_data['currency']} {payment_data['amount']} through this secure link: {payment_data['payment_link']}\n\nThis exclusive offer is only valid for the next 60 minutes, so I recommend completing the payment right away to secure your registration. Our payment process is completely secure and takes just a minute."
+        payment_chat_message = {"role": "assistant", "content": payment_message}
         
-        # Try to find the user with the provided identifiers
-        user = UserProfile.find_user(identifiers)
+        events.append({"type": "message", "text": payment_message})
         
-        if not user:
-            # Create temporary user with this session
-            user = UserProfile.create_or_update_user(
-                {"session_id": session_id},
-                {
-                    "is_temporary": True,
-                    "created_at": datetime.now().isoformat(),
-                    "last_active": datetime.now().isoformat()
-                }
-            )
-            logger.info(f"Created temporary user for document upload (session: {session_id})")
-        else:
-            logger.info(f"Found existing user for document upload")
+        # Send payment link to show in UI
+        events.append({"type": "payment_link", "link": payment_data["payment_link"]})
     
-    # In memory fallback - use session ID directly
-    elif session_id in active_connections:
-        actual_session_id = session_id
-    else:
-        # Simplified session ID mapping for in-memory mode
-        # Try to find exact match in chat_histories
-        if session_id in chat_histories:
-            actual_session_id = session_id
-        else:
-            # Try partial matching only if absolutely necessary
-            for conn_id in chat_histories:
-                if session_id.endswith(conn_id[-8:]) or conn_id.endswith(session_id[-8:]):
-                    actual_session_id = conn_id
-                    logger.info(f"Mapped session ID {session_id} to {actual_session_id}")
-                    break
-            
-            if actual_session_id != session_id:
-                logger.info(f"Using mapped session ID {actual_session_id}")
+    if DB_AVAILABLE:
+        # Verification, payment link and chat message are stored in one update
+        await asyncio.to_thread(
+            UserProfile.record_document_approval,
+            session_id,
+            verification_data,
+            payment_data_to_store,
+            payment_chat_message,
+            summary_updates_for_message(payment_chat_message) if payment_chat_message else None
+        )
+    elif payment_chat_message:
+        memory_store.session(session_id).payment = payment_data_to_store
+        # Add message to chat history
+        await add_to_chat_history(session_id, payment_chat_message)
+    
+    await send_bot_events(websocket, events)
+
+async def _on_document_rejected(websocket: WebSocket, session_id: str, analysis: str):
+    """Tell a connected user why their document was rejected, with upload tips, and ask for a new one."""
+    # Create a detailed rejection message
+    rejection_message = f"I've reviewed your document, but there seems to be an issue: {analysis}\n\nWe need a valid identity document (like Aadhaar, PAN card, or passport) that clearly shows your name and other details. This is a critical step for your company registration process. Could you please upload a proper identity document? It will only take a moment and ensures we can proceed with your registration without any delays."
     
-    # Create uploads directory with absolute path if it doesn't exist
-    uploads_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "uploads")
-    os.makedirs(uploads_dir, exist_ok=True)
+    # Add to chat history with metadata
+    metadata = {
+        "document_analysis": analysis,
+        "document_status": "rejected"
+    }
     
-    # Generate a unique file name for the document
-    unique_id = str(uuid.uuid4())
-    file_path = os.path.join(uploads_dir, f"{unique_id}_{document.filename}")
+    await add_to_chat_history(session_id, {
+        "role": "assistant",
+        "content": rejection_message,
+        "metadata": metadata
+    })
     
-    # Save the uploaded file
-    with open(file_path, "wb") as f:
-        f.write(await document.read())
+    # Send the rejection message with enhanced logging
+    if not is_connected(websocket):
+        logger.warning(f"Cannot send rejection message - WebSocket not connected for session {session_id}")
+        return
     
-    logger.info(f"Document saved to {file_path}")
+    logger.info(f"Sending rejection message to client for session {session_id}")
+    
+    try:
+        # The rejection, any advice and the upload prompt go out together in one frame
+        events = [{"type": "message", "text": rejection_message}]
+        
+        # Extract specific issues to guide the user better
+        analysis_lc = analysis.lower()
+        issues = list(dict.fromkeys(DOCUMENT_ISSUES[keyword] for keyword in DOCUMENT_ISSUE_RE.findall(analysis_lc)))
+        
+        # If specific issues were identified, send follow-up advice
+        if issues:
+            specific_advice = "Here are some tips for a better upload:\n" + "\n".join([f"- {issue}" for issue in issues])
+            specific_advice += "\n\nPlease ensure good lighting, no glare, and that the entire document is visible."
+            
+            events.append({"type": "message", "text": specific_advice})
+            
+            # Add advice to chat history
+            await add_to_chat_history(session_id, {
+                "role": "assistant",
+                "content": specific_advice,
+                "metadata": {"type": "document_advice"}
+            })
+        
+        # Request another document upload
+        events.append({"type": "show_document_upload"})
+        await send_bot_events(websocket, events)
+        
+        logger.info(f"Document verification failed for session {session_id}. Requested new document upload. Issues: {issues}")
+    except Exception as message_error:
+        logger.error(f"Error sending document verification message: {str(message_error)}", exc_info=True)
+
+async def process_uploaded_document(session_id: str, user: Optional[Dict[str, Any]], file_path: str,
+                                   filename: str, unique_id: str, now: datetime):
+    """
+    Upload a saved document to Cloudinary, verify it, store the result and tell the user over the WebSocket.
+    Runs after /upload-document has already answered, so the upload request never waits on this work.
+    """
+    # The Cloudinary upload and the vision verification are independent, so both start now and run concurrently
+    cloudinary_task = None
+    if CLOUDINARY_AVAILABLE and cloudinary_storage and cloudinary_storage.is_available:
+        cloudinary_task = asyncio.create_task(cloudinary_storage.upload_document(file_path))
+    
+    # Convert local path to absolute URL for the API
+    # The file_path is already absolute, so we can use it directly
+    document_url = f"file://{file_path}"
+    
+    verification_task = None
+    if os.environ.get("OPENAI_API_KEY"):
+        logger.info(f"Verifying document: {document_url}")
+        # The document is uploaded to Cloudinary above and stored with its result below, so the tool does neither
+        verification_task = asyncio.create_task(
+            verify_document_with_vision(document_url, upload_to_cloudinary=False)
+        )
     
     # Store in Cloudinary if available
     cloudinary_url = None
-    if CLOUDINARY_AVAILABLE and cloudinary_storage and cloudinary_storage.is_available:
+    if cloudinary_task:
         try:
-            cloudinary_result = await cloudinary_storage.upload_document(file_path)
+            cloudinary_result = await cloudinary_task
             if cloudinary_result:
                 cloudinary_url = cloudinary_result["secure_url"]
                 logger.info(f"Document uploaded to Cloudinary: {cloudinary_url}")
@@ -1275,315 +1396,124 @@ async def upload_document(
         "document_id": f"doc_{unique_id}",
         "pending": False,
         "file_path": file_path,
-        "filename": document.filename,
-        "uploaded_at": datetime.now().isoformat()
+        "filename": filename,
+        "uploaded_at": now
     }
     
     if cloudinary_url:
         document_data["cloudinary_url"] = cloudinary_url
     
-    # Store document data
-    if DB_AVAILABLE:
-        # Use the user ID we found earlier if possible
-        if user and "_id" in user:
-            document_data["user_id"] = user["_id"]
-        
-        # Update using proper identifier
-        if cookie_id:
-            UserProfile.update_document_info(actual_session_id, document_data)
-            logger.info(f"Document info added to user identified by cookie and session")
-        else:
-            UserProfile.update_document_info(actual_session_id, document_data)
-            logger.info(f"Document info added to user identified by session only")
+    # Use the user ID we found earlier if possible
+    if user and "_id" in user:
+        document_data["user_id"] = user["_id"]
+    
+    # Process document with vision API
+    if verification_task:
+        # Wait for the verification started alongside the Cloudinary upload
+        verification_result = await verification_task
     else:
+        # If OpenAI API key is not available, simulate document verification
+        logger.warning("OpenAI API key not available, simulating document verification")
+        verification_result = simulate_document_verification()
+    
+    is_valid = verification_result["is_valid"]
+    
+    # The document is stored once, together with its verification result
+    document_data.update({
+        "verified": is_valid,
+        "analysis": verification_result["analysis"],
+        "next_steps": verification_result["next_steps"]
+    })
+    if not is_valid:
+        document_data["pending"] = True  # Keep document_status pending for reupload
+    
+    websocket = active_connections.get(session_id)
+    
+    if not DB_AVAILABLE:
         # Use in-memory storage
-        document_status[actual_session_id] = document_data
-        logger.info(f"Document info stored in memory for session {actual_session_id}")
+        memory_store.session(session_id).document = document_data
+        logger.info(f"Document info stored in memory for session {session_id}")
+    elif not (is_valid and websocket):
+        # An approved document for a connected user is stored by _on_document_verified, with its payment link
+        await asyncio.to_thread(UserProfile.update_document_info, session_id, document_data)
+        logger.info(f"Document info added to user for session {session_id}")
     
-    # Process document with vision API
-    try:
-        # Convert local path to absolute URL for the API
-        # The file_path is already absolute, so we can use it directly
-        document_url = f"file://{file_path}"
-        
-        if os.environ.get("OPENAI_API_KEY"):
-            # Verify document
-            logger.info(f"Verifying document: {document_url}")
-            verification_result = await verify_document_with_vision(document_url, actual_session_id)
-            
-            # Update document status in DB or memory
-            updated_doc_data = {
-                "verified": verification_result["is_valid"],
-                "analysis": verification_result["analysis"],
-                "next_steps": verification_result["next_steps"]
-            }
-            
-            if DB_AVAILABLE:
-                # Update existing document info
-                UserProfile.update_document_info(actual_session_id, updated_doc_data)
-            else:
-                # Update in-memory status
-                document_status[actual_session_id].update(updated_doc_data)
-            
-            # Send response to client
-            if actual_session_id in active_connections:
-                websocket = active_connections[actual_session_id]
-                
-                if verification_result["is_valid"]:
-                    await send_bot_message(
-                        websocket,
-                        "Thank you! I've verified your document and everything looks good. We can now proceed with the registration process."
-                    )
-                    
-                    # If document is valid, transition to payment step
-                    # Generate and send payment link
-                    user_data = None
-                    if DB_AVAILABLE:
-                        user_data = UserProfile.get_by_session(actual_session_id)
-                    
-                    if user_data:
-                        customer_info = {k: v for k, v in user_data.items() if k in ["name", "email", "phone"]}
-                    else:
-                        customer_info = user_info.get(actual_session_id, {})
-                        if not customer_info:
-                            customer_info = {"name": "Customer", "email": f"customer_{actual_session_id[:8]}@example.com"}
-                    
-                    payment_data = generate_razorpay_link(customer_info)
-                    
-                    if payment_data["success"]:
-                        # Store payment info in DB or memory
-                        payment_data_to_store = {
-                            "pending": True,
-                            "link": payment_data["payment_link"],
-                            "amount": payment_data["amount"],
-                            "currency": payment_data["currency"]
-                        }
-                        
-                        if DB_AVAILABLE:
-                            UserProfile.update_payment_info(actual_session_id, payment_data_to_store)
-                        else:
-                            payment_status[actual_session_id] = payment_data_to_store
-                        
-                        # Send payment link message
-                        payment_message = f"Great news! Your document has been verified and approved. To proceed with your company registration, please complete the payment of {payment_data['currency']} {payment_data['amount']} through this secure link: {payment_data['payment_link']}\n\nThis exclusive offer is only valid for the next 60 minutes, so I recommend completing the payment right away to secure your registration. Our payment process is completely secure and takes just a minute."
-                        
-                        await send_bot_message(websocket, payment_message)
-                        
-                        # Add message to chat history
-                        if DB_AVAILABLE:
-                            UserProfile.add_message_to_conversation(actual_session_id, {"role": "assistant", "content": payment_message})
-                        else:
-                            if actual_session_id not in chat_histories:
-                                chat_histories[actual_session_id] = []
-                            chat_histories[actual_session_id].append({"role": "assistant", "content": payment_message})
-                        
-                        # Send payment link to show in UI
-                        await send_payment_link(websocket, payment_data["payment_link"])
-                else:
-                    # Document is invalid - keep document_status pending
-                    if DB_AVAILABLE:
-                        UserProfile.update_document_info(actual_session_id, {"pending": True})
-                    else:
-                        document_status[actual_session_id]["pending"] = True
-                    
-                    # Create a detailed rejection message
-                    rejection_message = f"I've reviewed your document, but there seems to be an issue: {verification_result['analysis']}\n\nWe need a valid identity document (like Aadhaar, PAN card, or passport) that clearly shows your name and other details. This is a critical step for your company registration process. Could you please upload a proper identity document? It will only take a moment and ensures we can proceed with your registration without any delays."
-                    
-                    # Add to chat history with metadata
-                    metadata = {
-                        "document_analysis": verification_result['analysis'],
-                        "document_status": "rejected"
-                    }
-                    
-                    if DB_AVAILABLE:
-                        UserProfile.add_message_to_conversation(
-                            actual_session_id, 
-                            {
-                                "role": "assistant", 
-                                "content": rejection_message,
-                                "metadata": metadata
-                            }
-                        )
-                    else:
-                        if actual_session_id not in chat_histories:
-                            chat_histories[actual_session_id] = []
-                        
-                        chat_histories[actual_session_id].append({
-                            "role": "assistant",
-                            "content": rejection_message,
-                            "metadata": metadata
-                        })
-                    
-                    # Send the rejection message with enhanced logging
-                    if websocket.client_state == WebSocketState.CONNECTED:
-                        logger.info(f"Sending rejection message to client for session {actual_session_id}")
-                        
-                        try:
-                            # Send the message and wait for it to be sent
-                            await send_bot_message(
-                                websocket,
-                                rejection_message
-                            )
-                            logger.info(f"Successfully sent rejection message to client")
-                            
-                            # Brief delay to ensure message is processed
-                            await asyncio.sleep(0.5)
-                            
-                            # Extract specific issues to guide the user better
-                            issues = []
-                            if "blurry" in verification_result['analysis'].lower():
-                                issues.append("Image is too blurry")
-                            if "dark" in verification_result['analysis'].lower():
-                                issues.append("Image is too dark")
-                            if "cropped" in verification_result['analysis'].lower() or "cut off" in verification_result['analysis'].lower():
-                                issues.append("Document is partially cropped or cut off")
-                            if "glare" in verification_result['analysis'].lower() or "reflection" in verification_result['analysis'].lower():
-                                issues.append("There's glare or reflection on the document")
-                            
-                            # If specific issues were identified, send follow-up advice
-                            if issues:
-                                specific_advice = "Here are some tips for a better upload:\n" + "\n".join([f"- {issue}" for issue in issues])
-                                specific_advice += "\n\nPlease ensure good lighting, no glare, and that the entire document is visible."
-                                
-                                await send_bot_message(
-                                    websocket,
-                                    specific_advice
-                                )
-                                
-                                # Add advice to chat history
-                                if DB_AVAILABLE:
-                                    UserProfile.add_message_to_conversation(
-                                        actual_session_id, 
-                                        {
-                                            "role": "assistant", 
-                                            "content": specific_advice,
-                                            "metadata": {"type": "document_advice"}
-                                        }
-                                    )
-                                else:
-                                    chat_histories[actual_session_id].append({
-                                        "role": "assistant",
-                                        "content": specific_advice,
-                                        "metadata": {"type": "document_advice"}
-                                    })
-                            
-                            # Request another document upload
-                            await request_document_upload(websocket)
-                            
-                            logger.info(f"Document verification failed for session {actual_session_id}. Requested new document upload. Issues: {issues}")
-                        except Exception as message_error:
-                            logger.error(f"Error sending document verification message: {str(message_error)}", exc_info=True)
-                    else:
-                        logger.warning(f"Cannot send rejection message - WebSocket not connected for session {actual_session_id}")
+    # Send response to client
+    if websocket:
+        if is_valid:
+            await _on_document_verified(websocket, session_id, document_data)
         else:
-            # If OpenAI API key is not available, simulate document verification
-            logger.warning("OpenAI API key not available, simulating document verification")
-            
-            # For simulation purposes, we'll have a 20% chance of document rejection
-            import random
-            is_valid = random.random() < 0.8
-            
-            if is_valid:
-                # Simulate successful verification
-                update_data = {
-                    "verified": True,
-                    "analysis": "Document appears to be valid (simulated).",
-                    "next_steps": "proceed_to_payment"
-                }
-                
-                if DB_AVAILABLE:
-                    UserProfile.update_document_info(actual_session_id, update_data)
-                else:
-                    document_status[actual_session_id].update(update_data)
-                
-                if actual_session_id in active_connections:
-                    websocket = active_connections[actual_session_id]
-                    
-                    success_message = "Thank you for uploading your document! I've verified it and everything looks good. We can now proceed with the registration process."
-                    
-                    # Add to chat history
-                    if DB_AVAILABLE:
-                        UserProfile.add_message_to_conversation(actual_session_id, {"role": "assistant", "content": success_message})
-                    else:
-                        if actual_session_id not in chat_histories:
-                            chat_histories[actual_session_id] = []
-                        
-                        chat_histories[actual_session_id].append({"role": "assistant", "content": success_message})
-                    
-                    await send_bot_message(
-                        websocket,
-                        success_message
-                    )
-            else:
-                # Simulate failed verification
-                update_data = {
-                    "verified": False,
-                    "analysis": "The document appears to be unclear or invalid. This appears to be a screenshot rather than a proper identity document.",
-                    "next_steps": "request_new_document",
-                    "pending": True  # Keep document_status pending for reupload
-                }
-                
-                if DB_AVAILABLE:
-                    UserProfile.update_document_info(actual_session_id, update_data)
-                else:
-                    document_status[actual_session_id].update(update_data)
-                
-                if actual_session_id in active_connections:
-                    websocket = active_connections[actual_session_id]
-                    
-                    # Create a detailed rejection message
-                    rejection_message = "I've reviewed your document, but there seems to be an issue: The document appears to be unclear or invalid. This appears to be a screenshot rather than a proper identity document.\n\nWe need a valid identity document (like Aadhaar, PAN card, or passport) that clearly shows your name and other details. Could you please upload a proper identity document? It will only take a moment and ensures we can proceed with your registration without any delays."
-                    
-                    # Add to chat history
-                    if DB_AVAILABLE:
-                        UserProfile.add_message_to_conversation(actual_session_id, {"role": "assistant", "content": rejection_message})
-                    else:
-                        if actual_session_id not in chat_histories:
-                            chat_histories[actual_session_id] = []
-                        
-                        chat_histories[actual_session_id].append({"role": "assistant", "content": rejection_message})
-                    
-                    # Send the rejection message with enhanced logging
-                    if websocket.client_state == WebSocketState.CONNECTED:
-                        logger.info(f"Sending simulated rejection message to client for session {actual_session_id}")
-                        
-                        try:
-                            # Send the message and wait for it to be sent
-                            await send_bot_message(
-                                websocket,
-                                rejection_message
-                            )
-                            logger.info(f"Successfully sent simulated rejection message to client")
-                            
-                            # Brief delay to ensure message is processed
-                            await asyncio.sleep(0.5)
-                            
-                            # Request another document upload
-                            await request_document_upload(websocket)
-                            
-                            logger.info(f"Simulated document verification failed for session {actual_session_id}. Requested new document upload.")
-                        except Exception as message_error:
-                            logger.error(f"Error sending simulated document verification message: {str(message_error)}", exc_info=True)
-                    else:
-                        logger.warning(f"Cannot send simulated rejection message - WebSocket not connected for session {actual_session_id}")
-                    
-                    # Return early as we don't want to proceed to payment
-                    return {"success": True, "is_valid": False}
-        
-        # Get verified status from DB or memory
-        is_verified = False
-        if DB_AVAILABLE:
-            user_data = UserProfile.get_by_session(actual_session_id)
-            if user_data and "document" in user_data:
-                is_verified = user_data["document"].get("verified", False)
-        else:
-            is_verified = document_status[actual_session_id].get("verified", False)
-        
-        return {"success": True, "is_valid": is_verified}
-        
+            await _on_document_rejected(websocket, session_id, verification_result["analysis"])
+
+async def run_document_processing(session_id: str, user: Optional[Dict[str, Any]], file_path: str,
+                                  filename: str, unique_id: str, now: datetime):
+    """Process an uploaded document in the background; failures are logged and the user is asked to upload again."""
+    try:
+        await process_uploaded_document(session_id, user, file_path, filename, unique_id, now)
     except Exception as e:
         logger.error(f"Error processing document: {str(e)}", exc_info=True)
-        return {"success": False, "error": str(e)}
+        websocket = active_connections.get(session_id)
+        if websocket:
+            await send_bot_events(websocket, [
+                {"type": "message", "text": "Sorry, something went wrong while checking your document. Could you please upload it again?"},
+                {"type": "show_document_upload"}
+            ])
+    finally:
+        document_tasks.discard(asyncio.current_task())
+
+@app.post("/upload-document")
+async def upload_document(
+    document: UploadFile = File(...),
+    session_id: str = Form(...),
+    cookie_id: str = Form(None),
+    device_id: str = Form(None)
+):
+    """Handle document upload."""
+    logger.info(f"Document upload requested for session {session_id}: {document.filename}")
+    
+    # One timestamp for every record this upload creates
+    now = datetime.now(timezone.utc)
+    
+    # Identify user - try device ID first, then cookie, then session
+    user = None
+    actual_session_id = session_id
+    
+    if DB_AVAILABLE:
+        # Only the user's ID is needed to link the document
+        user = await find_request_user(session_id, cookie_id, device_id, {"_id": 1})
+        
+        if not user:
+            # Create temporary user with this session
+            user = await asyncio.to_thread(UserProfile.create_or_update_user,
+                {"session_id": session_id},
+                {"is_temporary": True}
+            )
+            logger.info(f"Created temporary user for document upload (session: {session_id})")
+        else:
+            logger.info(f"Found existing user for document upload")
+    
+    # In memory fallback - use the session ID or the session it maps to
+    else:
+        actual_session_id = resolve_memory_session(session_id)
+    
+    # Generate a unique file name for the document
+    unique_id = uuid.uuid4().hex
+    # Only the base name of the client's file name is used, so it cannot point outside the uploads directory
+    safe_filename = FILENAME_UNSAFE_RE.sub('_', os.path.basename(document.filename or "document"))
+    file_path = os.path.join(uploads_dir, f"{unique_id}_{safe_filename}")
+    
+    # Save the uploaded file, streaming it to disk in chunks
+    async with aiofiles.open(file_path, "wb") as f:
+        while chunk := await document.read(UPLOAD_CHUNK_SIZE):
+            await f.write(chunk)
+    
+    logger.info(f"Document saved to {file_path}")
+    
+    # Verification, the payment link and the reply to the user continue in the background
+    task = asyncio.create_task(run_document_processing(actual_session_id, user, file_path, document.filename, unique_id, now))
+    document_tasks.add(task)
+    
+    return {"success": True, "status": "processing"}
 
 @app.get("/payment-details/{payment_id}")
 async def payment_details_endpoint(payment_id: str, session_id: str, cookie_id: str = None, device_id: str = None):
@@ -1591,7 +1521,7 @@ async def payment_details_endpoint(payment_id: str, session_id: str, cookie_id:
     logger.info(f"Fetching payment details for: {payment_id}, session: {session_id}")
     
     # Sanitize the payment ID to ensure it's safe
-    payment_id = re.sub(r'[^a-zA-Z0-9_-]', '', payment_id)
+    payment_id = PAYMENT_ID_UNSAFE_RE.sub('', payment_id)
     logger.info(f"Sanitized payment ID: {payment_id}")
     
     # Identify user - try device ID first, then cookie, then session
@@ -1599,21 +1529,7 @@ async def payment_details_endpoint(payment_id: str, session_id: str, cookie_id:
     actual_session_id = session_id
     
     if DB_AVAILABLE:
-        identifiers = {}
-        
-        # Use device ID as strongest identifier if provided
-        if device_id:
-            identifiers["device_id"] = device_id
-            
-        # Use cookie ID if provided
-        if cookie_id:
-            identifiers["cookie_id"] = cookie_id
-        
-        # Always include session ID as a fallback
-        identifiers["session_id"] = session_id
-        
-        # Try to find the user with the provided identifiers
-        user = UserProfile.find_user(identifiers)
+        user = await find_request_user(session_id, cookie_id, device_id, {"payment": 1})
         
         if not user:
             logger.warning(f"No user found for payment details (session: {session_id}, cookie: {cookie_id})")
@@ -1644,8 +1560,9 @@ async def payment_details_endpoint(payment_id: str, session_id: str, cookie_id:
             }
     else:
         # In-memory storage
-        if session_id in payment_status:
-            payment_info = payment_status[session_id]
+        session = sessions.get(session_id)
+        if session and session.payment is not None:
+            payment_info = session.payment
             return {
                 "amount": payment_info.get("amount", 5000),
                 "currency": payment_info.get("currency", "INR"),
@@ -1665,7 +1582,7 @@ async def payment_details_endpoint(payment_id: str, session_id: str, cookie_id:
 async def check_payment_endpoint(payment_id: str, session_id: str, cookie_id: str = None, device_id: str = None):
     """Endpoint to check payment status."""
     # Sanitize the payment ID to ensure it's safe
-    payment_id = re.sub(r'[^a-zA-Z0-9_-]', '', payment_id)
+    payment_id = PAYMENT_ID_UNSAFE_RE.sub('', payment_id)
     logger.info(f"Checking payment status for: {payment_id}, session: {session_id}")
     
     # Identify user - try device ID first, then cookie, then session
@@ -1673,21 +1590,7 @@ async def check_payment_endpoint(payment_id: str, session_id: str, cookie_id: st
     actual_session_id = session_id
     
     if DB_AVAILABLE:
-        identifiers = {}
-        
-        # Use device ID as strongest identifier if provided
-        if device_id:
-            identifiers["device_id"] = device_id
-            
-        # Use cookie ID if provided
-        if cookie_id:
-            identifiers["cookie_id"] = cookie_id
-        
-        # Always include session ID as a fallback
-        identifiers["session_id"] = session_id
-        
-        # Try to find the user with the provided identifiers
-        user = UserProfile.find_user(identifiers)
+        user = await find_request_user(session_id, cookie_id, device_id, {"_id": 1})
         
         if not user:
             logger.warning(f"No user found for payment check (session: {session_id}, cookie: {cookie_id})")
@@ -1695,31 +1598,18 @@ async def check_payment_endpoint(payment_id: str, session_id: str, cookie_id: st
         
         logger.info(f"Found user for payment check")
     
-    # In memory fallback - use session ID directly
-    elif session_id in active_connections:
-        actual_session_id = session_id
+    # In memory fallback - use the session ID or the session it maps to
     else:
-        # Check in chat histories
-        if session_id in chat_histories:
-            actual_session_id = session_id
-        else:
-            # Simplified partial matching for in-memory mode
-            for conn_id in chat_histories:
-                if session_id.endswith(conn_id[-8:]) or conn_id.endswith(session_id[-8:]):
-                    actual_session_id = conn_id
-                    logger.info(f"Mapped session ID {session_id} to {actual_session_id}")
-                    break
-            
-            if actual_session_id != session_id:
-                logger.info(f"Using mapped session ID {actual_session_id}")
+        actual_session_id = resolve_memory_session(session_id)
     
     try:
-        payment_result = check_payment_status(payment_id)
+        payment_result = await asyncio.to_thread(check_payment_status, payment_id)
+        checked_at = datetime.now(timezone.utc)
         
         # Create comprehensive payment update with all relevant details
         payment_update = {
             "status": payment_result["status"],
-            "checked_at": datetime.now().isoformat(),
+            "checked_at": checked_at,
             "payment_id": payment_id,
             "amount": payment_result.get("amount", 5000),
             "currency": payment_result.get("currency", "INR"),
@@ -1731,19 +1621,20 @@ async def check_payment_endpoint(payment_id: str, session_id: str, cookie_id: st
             payment_update.update({
                 "pending": False,
                 "completed": True,
-                "completed_at": datetime.now().isoformat()
+                "completed_at": checked_at
             })
             
             # Mark case as won in the database
             if DB_AVAILABLE:
-                UserProfile.mark_case_outcome(actual_session_id, True, "Payment completed successfully")
+                await asyncio.to_thread(UserProfile.mark_case_outcome, actual_session_id, True, "Payment completed successfully")
         
         # Store payment update
         if DB_AVAILABLE:
-            UserProfile.update_payment_info(actual_session_id, payment_update)
+            await asyncio.to_thread(UserProfile.update_payment_info, actual_session_id, payment_update)
         else:
-            if actual_session_id in payment_status:
-                payment_status[actual_session_id].update(payment_update)
+            session = sessions.get(actual_session_id)
+            if session and session.payment is not None:
+                session.payment.update(payment_update)
         
         # If payment is completed, notify the user
         if payment_result["payment_completed"]:
@@ -1754,12 +1645,12 @@ async def check_payment_endpoint(payment_id: str, session_id: str, cookie_id: st
                 company_type = "private limited"  # Default
                 
                 if DB_AVAILABLE:
-                    user_data = UserProfile.get_by_session(actual_session_id)
+                    user_data = await asyncio.to_thread(UserProfile.get_fields, actual_session_id, {"company_type": 1})
                     if user_data:
                         company_type = user_data.get("company_type", "").lower()
                 else:
-                    if actual_session_id in user_info:
-                        company_type = user_info[actual_session_id].get("company_type", "").lower()
+                    if actual_session_id in sessions:
+                        company_type = sessions[actual_session_id].user.get("company_type", "").lower()
                 
                 # Determine document requirements based on company type
                 doc_requirements = {}
@@ -1784,11 +1675,9 @@ async def check_payment_endpoint(payment_id: str, session_id: str, cookie_id: st
                 
                 # Store document requirements in user profile
                 if DB_AVAILABLE:
-                    UserProfile.create_or_update(actual_session_id, {"doc_requirements": doc_requirements})
+                    await asyncio.to_thread(UserProfile.create_or_update, actual_session_id, {"doc_requirements": doc_requirements})
                 else:
-                    if actual_session_id not in user_info:
-                        user_info[actual_session_id] = {}
-                    user_info[actual_session_id]["doc_requirements"] = doc_requirements
+                    memory_store.session(actual_session_id).user["doc_requirements"] = doc_requirements
                 
                 # Create payment success message
                 success_message = "Fantastic news! Your payment has been successfully received. We've already started processing your company registration. Our team will contact you shortly for the next steps. Thank you for choosing RegisterKaro for your company incorporation needs!"
@@ -1805,21 +1694,11 @@ async def check_payment_endpoint(payment_id: str, session_id: str, cookie_id: st
                 full_message = success_message + doc_message
                 
                 # Add to chat history
-                if DB_AVAILABLE:
-                    UserProfile.add_message_to_conversation(
-                        actual_session_id,
-                        {
-                            "role": "assistant",
-                            "content": full_message,
-                            "metadata": {"type": "payment_confirmation_with_docs"}
-                        }
-                    )
-                else:
-                    chat_histories[actual_session_id].append({
-                        "role": "assistant",
-                        "content": full_message,
-                        "metadata": {"type": "payment_confirmation_with_docs"}
-                    })
+                await add_to_chat_history(actual_session_id, {
+                    "role": "assistant",
+                    "content": full_message,
+                    "metadata": {"type": "payment_confirmation_with_docs"}
+                })
                 
                 await send_bot_message(websocket, full_message)
         
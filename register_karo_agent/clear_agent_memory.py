@@ -8,7 +8,9 @@ import os
 import logging
 import json
 import dotenv
-from datetime import datetime
+from cachetools import TTLCache
+from pymongo import UpdateMany
+from pymongo.write_concern import WriteConcern
 from database.db_connection import mongo_db
 from database.models import UserProfile
 
@@ -19,6 +21,38 @@ dotenv.load_dotenv()
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger("clear_agent_memory")
 
+# Most recently active sessions listed by get_active_sessions
+ACTIVE_SESSIONS_LIMIT = 200
+
+# Session listings served from memory for a few seconds so repeated calls share one query
+SESSIONS_CACHE_TTL = 5
+_sessions_cache: TTLCache = TTLCache(maxsize=1, ttl=SESSIONS_CACHE_TTL)
+
+# Users reset per update when clearing memory across a large collection
+CLEAR_CHUNK_SIZE = 10000
+
+def _id_ranges(collection, chunk_size):
+    """Split a collection into _id range filters of about chunk_size documents each."""
+    # Each bound is found on the server by skipping chunk_size entries of the _id index,
+    # so one _id per chunk crosses the network instead of every _id in the collection
+    bounds = []
+    query = {}
+    skip = 0
+    while True:
+        bound = next(collection.find(query, {"_id": 1}).sort("_id", 1).skip(skip).limit(1), None)
+        if bound is None:
+            break
+        bounds.append(bound["_id"])
+        query = {"_id": {"$gte": bound["_id"]}}
+        skip = chunk_size
+    ranges = []
+    for lower, upper in zip(bounds, bounds[1:] + [None]):
+        id_range = {"$gte": lower}
+        if upper is not None:
+            id_range["$lt"] = upper
+        ranges.append({"_id": id_range})
+    return ranges
+
 def clear_agent_memory():
     """
     Clear agent memory context by:
@@ -31,7 +65,7 @@ def clear_agent_memory():
     # Initialize MongoDB connection
     mongo_db.initialize()
     
-    if mongo_db.is_connected == False:
+    if not mongo_db.is_connected:
         logger.error("Failed to connect to MongoDB. Cannot clear agent memory.")
         return 0
     
@@ -42,38 +76,51 @@ def clear_agent_memory():
         logger.error("Failed to get collections. Cannot clear agent memory.")
         return 0
     
-    # Update timestamp
-    now = datetime.now().isoformat()
-    
     # Clear conversation history and context summaries for all users
-    update_result = users_collection.update_many(
-        {},  # Match all documents
-        {
-            "$set": {
-                "conversation": [],  # Clear conversation history
-                "context_summary": "",  # Clear context summary
-                "memory_cleared_at": now  # Record when memory was cleared
-            },
-            "$unset": {
-                "context_updated_at": ""  # Remove context timestamp
-            }
+    reset = {
+        "$set": {
+            "conversation": [],  # Clear conversation history
+            "message_count": 0,  # Restart the summary refresh cadence with the conversation
+            "context_summary": ""  # Clear context summary
+        },
+        "$currentDate": {
+            "memory_cleared_at": {"$type": "date"}  # Server stamps when memory was cleared
+        },
+        "$unset": {
+            "context_updated_at": "",  # Remove context timestamp
+            "summary_state": ""  # Remove the incrementally maintained summary state
         }
-    )
+    }
+    
+    # Acknowledged by the primary only, without waiting for the journal or replicas: losing a
+    # memory reset to a failover just leaves old conversations in place, and it can be rerun
+    users_collection = users_collection.with_options(write_concern=WriteConcern(w=1, j=False))
+    
+    if users_collection.estimated_document_count() <= CLEAR_CHUNK_SIZE:
+        update_result = users_collection.update_many({}, reset)
+    else:
+        # Reset large collections in _id ranges so the server yields between chunks
+        # and each oplog entry stays small
+        update_result = users_collection.bulk_write(
+            [UpdateMany(id_range, reset) for id_range in _id_ranges(users_collection, CLEAR_CHUNK_SIZE)],
+            ordered=False
+        )
     
     modified_count = update_result.modified_count
     logger.info(f"Cleared agent memory context for {modified_count} users")
     
-    # Close connection
-    mongo_db.close()
-    
     return modified_count
 
 def get_active_sessions():
-    """Get a list of all active user sessions and their basic information."""
+    """Get the most recently active user sessions and their basic information."""
+    cached = _sessions_cache.get("all")
+    if cached is not None:
+        return cached
+    
     # Initialize MongoDB connection
     mongo_db.initialize()
     
-    if mongo_db.is_connected == False:
+    if not mongo_db.is_connected:
         logger.error("Failed to connect to MongoDB. Cannot get active sessions.")
         return []
     
@@ -88,23 +135,17 @@ def get_active_sessions():
     sessions = list(users_collection.find(
         {},
         {
-            "session_id": 1,
+            "_id": 0,  # Not shown, and skipping it avoids converting each ObjectId to a string
+            "sessions": {"$slice": -1},  # Only the latest session ID
             "created_at": 1,
-            "updated_at": 1,
-            "contact.name": 1,
-            "contact.email": 1,
-            "contact.phone": 1
+            "last_active": 1,
+            "name": 1,
+            "email": 1,
+            "phone": 1
         }
-    ).sort("updated_at", -1))
-    
-    # Convert ObjectId to string for JSON serialization
-    for session in sessions:
-        if "_id" in session:
-            session["_id"] = str(session["_id"])
-    
-    # Close connection
-    mongo_db.close()
+    ).sort("last_active", -1).limit(ACTIVE_SESSIONS_LIMIT).batch_size(100))
     
+    _sessions_cache["all"] = sessions
     return sessions
 
 # Immediately execute the function when run directly
@@ -133,12 +174,13 @@ if __name__ == "__main__":
         print(f"\nFound {len(sessions)} active sessions:")
         
         for idx, session in enumerate(sessions, 1):
-            name = session.get("contact", {}).get("name", "Unknown")
-            email = session.get("contact", {}).get("email", "No email")
+            name = session.get("name", "Unknown")
+            email = session.get("email", "No email")
             created = session.get("created_at", "Unknown")
-            updated = session.get("updated_at", "Unknown")
+            updated = session.get("last_active", "Unknown")
+            latest_session = session["sessions"][-1] if session.get("sessions") else "Unknown"
             
-            print(f"{idx}. Session: {session.get('session_id', 'Unknown')}")
+            print(f"{idx}. Session: {latest_session}")
             print(f"   Name: {name}, Email: {email}")
             print(f"   Created: {created}, Last active: {updated}")
             print()
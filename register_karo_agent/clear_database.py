@@ -18,20 +18,21 @@ def clear_database():
             return False
         
         # Get the database
-        db = mongo_db.client.get_database()
+        db = mongo_db.db
         
         # Get all collection names
         collections = db.list_collection_names()
         
-        # Clear each collection
+        # Drop each collection, which frees its storage in one operation instead of deleting every document
         for collection_name in collections:
             if collection_name.startswith('system.'):
                 continue  # Skip system collections
             
-            collection = db[collection_name]
-            count_before = collection.count_documents({})
-            collection.delete_many({})
-            logger.info(f"Cleared collection '{collection_name}' - removed {count_before} documents")
+            db.drop_collection(collection_name)
+            logger.info(f"Dropped collection '{collection_name}'")
+        
+        # Dropping a collection also drops its indexes, so recreate the ones the app relies on
+        mongo_db.ensure_indexes()
         
         logger.info("Database cleared successfully!")
         return True
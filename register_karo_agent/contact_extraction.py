@@ -0,0 +1,25 @@
+"""
+Contact extraction - picks a name, email and phone number out of a user message
+"""
+import re
+from typing import Dict
+
+# Only the introduction is case-insensitive; the name itself is one or two capitalised words,
+# so it cannot run on into the rest of the sentence ("I am interested", "my email is ...")
+NAME_RE = re.compile(r"\b(?i:my name is|i am)\s+([A-Z][a-z]+(?:\s+[A-Z][a-z]+)?)\b")
+EMAIL_RE = re.compile(r'[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}')
+# Simple pattern for Indian numbers
+PHONE_RE = re.compile(r'\+91[0-9]{10}|[6-9][0-9]{9}')
+
+def extract_contact_details(message: str) -> Dict[str, str]:
+    """
+    Find a name, email and phone number in a message.
+    Each pattern is searched across the whole message on its own, so one match never hides another.
+    Returns only the fields that were found.
+    """
+    details = {}
+    for field, pattern in (("name", NAME_RE), ("email", EMAIL_RE), ("phone", PHONE_RE)):
+        match = pattern.search(message)
+        if match:
+            details[field] = match.group(match.lastindex or 0)
+    return details
@@ -1,6 +1,8 @@
 import os
+import atexit
 import logging
-from typing import Optional
+import threading
+from typing import Dict, Optional
 from pymongo import MongoClient
 from pymongo.database import Database
 from pymongo.collection import Collection
@@ -10,21 +12,28 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(level
 logger = logging.getLogger(__name__)
 
 class MongoDB:
-    _instance = None
+    """MongoDB connection shared by the whole process through the module-level mongo_db instance."""
     
-    def __new__(cls):
-        if cls._instance is None:
-            cls._instance = super(MongoDB, cls).__new__(cls)
-            cls._instance._client = None
-            cls._instance._db = None
-            cls._instance._initialized = False
-        return cls._instance
+    def __init__(self):
+        self._client: Optional[MongoClient] = None
+        self._db: Optional[Database] = None
+        self._initialized = False
+        # Collection objects handed out by get_collection, built once per name
+        self._collections: Dict[str, Collection] = {}
+        # Queries run in worker threads, so the lazy connect must only happen once
+        self._init_lock = threading.Lock()
     
     def initialize(self):
         """Initialize MongoDB connection."""
         if self._initialized:
             return
         
+        with self._init_lock:
+            if not self._initialized:
+                self._connect()
+    
+    def _connect(self):
+        """Connect to MongoDB and verify the connection."""
         try:
             # Get connection string from environment variables
             mongo_uri = os.environ.get("MONGODB_URI")
@@ -35,14 +44,15 @@ class MongoDB:
                 self._initialized = False
                 return
             
-            # Connect to MongoDB with explicit SSL settings
-            # Add SSL configuration options to make it work across different environments
+            # Connect to MongoDB over TLS; the client builds one SSL context that its pooled sockets share
+            # MONGODB_TLS_INSECURE=1 skips certificate validation for hosts without a usable CA store
             self._client = MongoClient(
                 mongo_uri,
-                ssl=True,
-                tlsAllowInvalidCertificates=True,  # Updated parameter name for certificate validation
+                tls=True,
+                tlsAllowInvalidCertificates=os.environ.get("MONGODB_TLS_INSECURE") == "1",
                 serverSelectionTimeoutMS=5000,  # Reduce timeout for faster fallback
                 connectTimeoutMS=5000,
+                minPoolSize=5,  # Keep a few sockets open so calls after idle periods skip the handshake
                 retryWrites=True
             )
             self._db = self._client[db_name]
@@ -54,6 +64,7 @@ class MongoDB:
                 
                 logger.info(f"Successfully connected to MongoDB. Database: {db_name}")
                 self._initialized = True
+                self.ensure_indexes()
             except Exception as ping_error:
                 logger.error(f"Failed to ping MongoDB: {str(ping_error)}")
                 logger.info("Will continue without MongoDB and use in-memory storage instead")
@@ -63,6 +74,26 @@ class MongoDB:
             logger.error(f"Error connecting to MongoDB: {str(e)}")
             self._initialized = False
     
+    def ensure_indexes(self):
+        """
+        Create the indexes behind the per-turn user lookups.
+        UserProfile.find_user looks users up by device_id, cookie_id, phone and the sessions
+        array in priority order, so each of the four is indexed.
+        has_completed_payment goes through the same lookup. Document uploads upsert on document_id.
+        The session listing in clear_agent_memory reads the most recent users by last_active.
+        create_index is a no-op for existing indexes, so scripts that drop collections can call this again.
+        """
+        try:
+            users = self._db["users"]
+            users.create_index("sessions")
+            users.create_index("cookie_id")
+            users.create_index("device_id")
+            users.create_index("phone")
+            users.create_index([("last_active", -1)])
+            self._db["documents"].create_index("document_id", unique=True)
+        except Exception as e:
+            logger.error(f"Error creating MongoDB indexes: {str(e)}")
+    
     @property
     def is_connected(self) -> bool:
         """Check if connected to MongoDB."""
@@ -82,15 +113,29 @@ class MongoDB:
         
         if not self._initialized:
             return None
-            
-        return self._db[collection_name]
+        
+        collection = self._collections.get(collection_name)
+        if collection is None:
+            collection = self._collections[collection_name] = self._db[collection_name]
+        return collection
     
     def close(self):
-        """Close the MongoDB connection."""
-        if self._client and self._initialized:
+        """
+        Close the MongoDB connection at process exit.
+        Safe to call more than once; also releases a client whose initial ping failed.
+        """
+        with self._init_lock:
+            if self._client is None:
+                return
             self._client.close()
-            logger.info("MongoDB connection closed")
+            self._client = None
+            self._db = None
+            self._collections.clear()
             self._initialized = False
+            logger.info("MongoDB connection closed")
+
+# The one database connection for the process; import this rather than creating MongoDB()
+mongo_db = MongoDB()
 
-# Singleton instance for database connection
-mongo_db = MongoDB()
\ No newline at end of file
+# The client and its pool live for the whole process and are closed once at exit
+atexit.register(mongo_db.close)
\ No newline at end of file
@@ -1,9 +1,16 @@
-from typing import List, Dict, Any, Optional, Union
-from datetime import datetime
+from typing import List, Dict, Any, Optional, Set, Union
+from datetime import datetime, timezone
 import logging
 import json
+import copy
+import itertools
 from bson import ObjectId
+from pymongo import ReturnDocument, UpdateOne
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import orjson
+from cachetools import Cache, LRUCache, TTLCache
 
 from .db_connection import mongo_db
 
@@ -11,6 +18,84 @@ from .db_connection import mongo_db
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Everything but digits and '+' is stripped from phone numbers before they are stored or matched
+PHONE_STRIP_RE = re.compile(r'[^0-9+]')
+
+# Short-lived cache of per-session reads: session_id -> {projection key: document}
+# Writes through UserProfile drop the entries of the sessions they were made for,
+# the TTL bounds everything else (other sessions of the same user, writes made elsewhere)
+# Cached documents are deep copies, so callers never share nested objects with the cache
+USER_CACHE_TTL = 2.0
+_USER_CACHE: TTLCache = TTLCache(maxsize=4096, ttl=USER_CACHE_TTL)
+# Reads and drops are stamped from one counter. A read only fills the cache if its session was not
+# dropped after the read started, so a read racing a write cannot cache what it saw before the write.
+_USER_CACHE_STAMPS = itertools.count(1)
+_USER_CACHE_DROPPED: LRUCache = LRUCache(maxsize=16384)  # session_id -> stamp of its last drop
+_USER_CACHE_CLEARED = 0  # Stamp of the last drop of every session
+
+class _UserIdCache(TTLCache):
+    """
+    TTLCache of identifier lookups -> user _id that also indexes each entry by the identifier
+    pairs in its key and by the _id it resolves to, so a write can drop only the entries it affects.
+    """
+    
+    def __init__(self, maxsize: int, ttl: float):
+        super().__init__(maxsize=maxsize, ttl=ttl)
+        self._keys_by_ref: Dict[Any, Set[tuple]] = {}
+    
+    def _unindex(self, key: tuple, user_id: ObjectId):
+        for ref in (*key, user_id):
+            keys = self._keys_by_ref.get(ref)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_ref[ref]
+    
+    def __setitem__(self, key: tuple, user_id: ObjectId):
+        # Expire first so the previous value of the key, if any, is still live when it is unindexed
+        self.expire()
+        self.pop(key, None)
+        super().__setitem__(key, user_id)
+        for ref in (*key, user_id):
+            self._keys_by_ref.setdefault(ref, set()).add(key)
+    
+    def __delitem__(self, key: tuple):
+        # Read the raw value: TTLCache still removes an expired entry, then raises KeyError
+        user_id = Cache.__getitem__(self, key)
+        try:
+            super().__delitem__(key)
+        finally:
+            self._unindex(key, user_id)
+    
+    def expire(self, time=None):
+        expired = super().expire(time)
+        for key, user_id in expired:
+            self._unindex(key, user_id)
+        return expired
+    
+    def clear(self):
+        super().clear()
+        self._keys_by_ref.clear()
+    
+    def forget(self, refs: Set[Any]):
+        """Drop every entry looked up by one of the identifier pairs in refs, or resolving to an _id in refs."""
+        for key in set().union(*(self._keys_by_ref.get(ref, ()) for ref in refs)):
+            self.pop(key, None)
+
+# Identifiers a user was found by -> that user's _id, so repeated lookups need one query by _id
+# Writes that can move identifiers between users drop the entries they touch; a stale _id just misses
+_USER_ID_CACHE = _UserIdCache(maxsize=10000, ttl=60)
+# Reads run in worker threads and TTLCache is not thread-safe
+_USER_CACHE_LOCK = threading.Lock()
+# Documents-collection writes run here so they overlap the user update instead of following it
+_DOCUMENT_WRITER = ThreadPoolExecutor(max_workers=4, thread_name_prefix="document-writer")
+
+def _bson_default(obj: Any) -> str:
+    """Serialize the BSON types orjson does not know about."""
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
 class UserProfile:
     """
     Simplified user profile model with single-document-per-user approach.
@@ -20,6 +105,23 @@ class UserProfile:
     COLLECTION_NAME = "users"
     DOCUMENTS_COLLECTION = "documents"
     
+    # The stored conversation keeps only its last CONVERSATION_MAXLEN messages so the user document
+    # stops growing; older turns live on in the summary state. message_count still counts every message.
+    CONVERSATION_MAXLEN = 200
+    
+    # Likewise only the last PAYMENT_HISTORY_MAXLEN payments are kept; current_payment and
+    # payment_status always reflect the latest one. Completed payments are also kept in
+    # completed_payments, which is never trimmed, so the cap cannot forget that a user has paid.
+    PAYMENT_HISTORY_MAXLEN = 50
+    COMPLETED_PAYMENT_STATUSES = ["completed", "captured"]
+    
+    # Projection expression that returns the number of messages without sending the conversation itself;
+    # users created before message_count was kept fall back to the length of their conversation
+    CONVERSATION_LENGTH = {"$ifNull": ["$message_count", {"$size": {"$ifNull": ["$conversation", []]}}]}
+    
+    # The arrays that grow with the user's history, left out when a write hands the user back
+    HISTORY_FIELDS = {"conversation": 0, "documents": 0, "payment_history": 0, "completed_payments": 0}
+    
     @classmethod
     def get_collection(cls) -> Optional[Any]:
         """Get the MongoDB collection."""
@@ -31,60 +133,138 @@ class UserProfile:
         return mongo_db.get_collection(cls.DOCUMENTS_COLLECTION)
     
     @classmethod
-    def find_user(cls, user_identifier: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    def _cached_find(cls, session_id: str, projection: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+        """Find a user by session ID, serving repeated reads within USER_CACHE_TTL from memory."""
+        key = json.dumps(projection, sort_keys=True)
+        with _USER_CACHE_LOCK:
+            cached = _USER_CACHE.get(session_id, {})
+            if key in cached:
+                return copy.deepcopy(cached[key])
+            stamp = next(_USER_CACHE_STAMPS)
+        
+        user = cls.find_user({"session_id": session_id}, projection)
+        with _USER_CACHE_LOCK:
+            cls._fill_cache(session_id, key, user, stamp)
+        return user
+    
+    @staticmethod
+    def _fill_cache(session_id: str, key: str, user: Optional[Dict[str, Any]], stamp: int):
         """
-        Find a user by various identifiers.
-        Prioritizes device_id > cookie_id > phone > session_id for identification.
+        Cache a copy of a read that started at stamp, unless the session's reads were dropped since.
+        The caller holds _USER_CACHE_LOCK.
         """
-        collection = cls.get_collection()
-        if collection is None:
-            logger.warning("MongoDB not available, cannot find user")
-            return None
-        
-        query = {"$or": []}
+        if _USER_CACHE_CLEARED < stamp and _USER_CACHE_DROPPED.get(session_id, 0) < stamp:
+            _USER_CACHE.setdefault(session_id, {})[key] = copy.deepcopy(user)
+    
+    @classmethod
+    def invalidate_cache(cls, session_id: Optional[str] = None):
+        """Drop cached reads for a session, or every cached read and identifier mapping when none is given."""
+        global _USER_CACHE_CLEARED
+        with _USER_CACHE_LOCK:
+            if session_id is None:
+                _USER_CACHE.clear()
+                _USER_ID_CACHE.clear()
+                _USER_CACHE_CLEARED = next(_USER_CACHE_STAMPS)
+            else:
+                _USER_CACHE.pop(session_id, None)
+                _USER_CACHE_DROPPED[session_id] = next(_USER_CACHE_STAMPS)
+    
+    @classmethod
+    def _forget_user_ids(cls, identifiers: List[Dict[str, Any]], user_id: Optional[ObjectId] = None):
+        """
+        Drop the cached identifier -> _id mappings a write can change:
+        those looked up by any of the given identifiers, and those resolving to the written user.
+        """
+        refs = {next(iter(query.items())) for identifier in identifiers for query in cls._identifier_queries(identifier)}
+        if user_id is not None:
+            refs.add(user_id)
+        # The cache indexes its entries by identifier pair and _id, so only the affected ones are touched
+        with _USER_CACHE_LOCK:
+            _USER_ID_CACHE.forget(refs)
+    
+    @staticmethod
+    def _identifier_queries(user_identifier: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """Build one single-field query per usable identifier, highest priority first."""
+        queries = []
         
         # Device ID has highest priority - unique per physical device
         if "device_id" in user_identifier and user_identifier["device_id"]:
-            query["$or"].append({"device_id": user_identifier["device_id"]})
+            queries.append({"device_id": user_identifier["device_id"]})
         
         # Cookie has second priority - persistent across browser sessions
         if "cookie_id" in user_identifier and user_identifier["cookie_id"]:
-            query["$or"].append({"cookie_id": user_identifier["cookie_id"]})
+            queries.append({"cookie_id": user_identifier["cookie_id"]})
             
         # Phone number has third priority
         if "phone" in user_identifier and user_identifier["phone"]:
             # Clean phone number
-            phone = re.sub(r'[^0-9+]', '', user_identifier["phone"])
+            phone = PHONE_STRIP_RE.sub('', user_identifier["phone"])
             if len(phone) >= 10:
-                query["$or"].append({"phone": phone})
+                queries.append({"phone": phone})
             
         # Session ID has lowest priority
         if "session_id" in user_identifier and user_identifier["session_id"]:
-            query["$or"].append({"sessions": user_identifier["session_id"]})
+            queries.append({"sessions": user_identifier["session_id"]})
         
-        # If no valid identifiers, return None
-        if not query["$or"]:
+        return queries
+    
+    @classmethod
+    def find_user(cls, user_identifier: Dict[str, Any], projection: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+        """
+        Find a user by various identifiers.
+        Prioritizes device_id > cookie_id > phone > session_id for identification.
+        If a projection is given, only those fields are returned.
+        """
+        # Without a usable identifier there is nothing to look up
+        queries = cls._identifier_queries(user_identifier)
+        if not queries:
             return None
-            
-        # Find the user
-        return collection.find_one(query)
+        
+        collection = cls.get_collection()
+        if collection is None:
+            logger.warning("MongoDB not available, cannot find user")
+            return None
+        
+        cache_key = tuple(next(iter(query.items())) for query in queries)
+        with _USER_CACHE_LOCK:
+            user_id = _USER_ID_CACHE.get(cache_key)
+        if user_id is not None:
+            user = collection.find_one({"_id": user_id}, projection)
+            if user is not None:
+                return user
+        
+        # Try the identifiers in priority order; each lookup is a single-field index scan,
+        # and the first match wins instead of whichever document an $or happens to return
+        for query in queries:
+            user = collection.find_one(query, projection)
+            if user is not None:
+                if "_id" in user:
+                    with _USER_CACHE_LOCK:
+                        _USER_ID_CACHE[cache_key] = user["_id"]
+                return user
+        
+        return None
     
     @classmethod
     def create_or_update_user(cls, identifier: Dict[str, Any], data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
         """
         Create a new user or update an existing one using phone/cookie/session.
-        Returns the user document with _id.
+        Returns the user document with _id; an updated user comes back without its HISTORY_FIELDS.
         """
+        # Only the sessions this write is made for or links to the user see their reads dropped
+        for session_id in [identifier.get("session_id"), *data.get("sessions", [])]:
+            if session_id:
+                cls.invalidate_cache(session_id)
         collection = cls.get_collection()
         if collection is None:
             logger.warning("MongoDB not available, cannot save user")
             return None
         
         # Find existing user first
-        existing_user = cls.find_user(identifier)
+        existing_user = cls.find_user(identifier, {"_id": 1})
         
         # Current timestamp
-        now = datetime.now().isoformat()
+        now = datetime.now(timezone.utc)
         
         if existing_user:
             # User exists, update with new data
@@ -92,10 +272,13 @@ class UserProfile:
             
             # Prepare update operations
             update_ops = {"$set": {}}
+            added_sessions = []
             
             # Update all provided fields
             for key, value in data.items():
-                if key != "_id":  # Don't try to update _id
+                if key == "sessions":
+                    added_sessions.extend(value)  # Sessions are linked to the user, never replaced
+                elif key != "_id":  # Don't try to update _id
                     update_ops["$set"][key] = value
             
             # Always update last_active timestamp
@@ -103,14 +286,20 @@ class UserProfile:
             
             # If session_id is provided, add it to sessions array
             if "session_id" in identifier and identifier["session_id"]:
-                update_ops["$addToSet"] = {"sessions": identifier["session_id"]}
+                added_sessions.append(identifier["session_id"])
+            if added_sessions:
+                update_ops["$addToSet"] = {"sessions": {"$each": added_sessions}}
             
-            # Execute update
-            collection.update_one({"_id": user_id}, update_ops)
+            # Update and return the updated user in one round-trip
+            updated_user = collection.find_one_and_update(
+                {"_id": user_id},
+                update_ops,
+                projection=cls.HISTORY_FIELDS,
+                return_document=ReturnDocument.AFTER
+            )
+            cls._forget_user_ids([identifier, data, *({"session_id": s} for s in added_sessions)], user_id)
             logger.info(f"Updated user profile {user_id}")
-            
-            # Return updated user
-            return collection.find_one({"_id": user_id})
+            return updated_user
         else:
             # User doesn't exist, create new
             new_user = {
@@ -128,7 +317,7 @@ class UserProfile:
                 new_user["device_id"] = identifier["device_id"]
             
             if "phone" in identifier and identifier["phone"]:
-                new_user["phone"] = re.sub(r'[^0-9+]', '', identifier["phone"])
+                new_user["phone"] = PHONE_STRIP_RE.sub('', identifier["phone"])
                 
             if "cookie_id" in identifier and identifier["cookie_id"]:
                 new_user["cookie_id"] = identifier["cookie_id"]
@@ -140,99 +329,168 @@ class UserProfile:
             new_user["conversation"] = []
             new_user["documents"] = []
             
-            # Insert new user
+            # Insert new user; insert_one adds the generated _id to new_user
             result = collection.insert_one(new_user)
+            cls._forget_user_ids([identifier, data])
             logger.info(f"Created new user profile with ID {result.inserted_id}")
             
             # Return new user
-            return collection.find_one({"_id": result.inserted_id})
+            return new_user
     
     @classmethod
-    def get_by_session(cls, session_id: str) -> Optional[Dict[str, Any]]:
+    def get_by_session(cls, session_id: str, recent_messages: Optional[int] = None) -> Optional[Dict[str, Any]]:
         """
         Get user by session ID.
         This maintains compatibility with the old API.
+        With recent_messages, only the last that many messages of the conversation are sent.
+        """
+        if recent_messages is not None:
+            return cls._cached_find(session_id, {"conversation": {"$slice": -recent_messages}})
+        return cls._cached_find(session_id)
+    
+    @classmethod
+    def get_fields(cls, session_id: str, projection: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """
+        Get only the given fields of the user for a session ID.
+        Avoids loading the full conversation history when a caller needs a few fields.
         """
-        return cls.find_user({"session_id": session_id})
+        return cls._cached_find(session_id, projection)
     
     @classmethod
-    def add_message_to_conversation(cls, session_id: str, message: Dict[str, Any]) -> bool:
+    def get_fields_many(cls, session_ids: List[str], projection: Dict[str, Any]) -> Dict[str, Optional[Dict[str, Any]]]:
+        """
+        Get the same fields for several session IDs with one query, through the read cache.
+        The projection must be an inclusion projection. Returns session_id -> user (None if unknown);
+        like get_fields, every user returned is a copy the caller may change.
+        """
+        key = json.dumps(projection, sort_keys=True)
+        users: Dict[str, Optional[Dict[str, Any]]] = {}
+        with _USER_CACHE_LOCK:
+            for session_id in session_ids:
+                cached = _USER_CACHE.get(session_id, {})
+                if key in cached:
+                    users[session_id] = copy.deepcopy(cached[key])
+            stamp = next(_USER_CACHE_STAMPS)
+        
+        missing = [session_id for session_id in session_ids if session_id not in users]
+        if not missing:
+            return users
+        
+        collection = cls.get_collection()
+        if collection is None:
+            logger.warning("MongoDB not available, cannot find users")
+            return {**users, **dict.fromkeys(missing)}
+        
+        # sessions is needed to tell which requested session each user belongs to
+        found = dict.fromkeys(missing)
+        for user in collection.find({"sessions": {"$in": missing}}, {**projection, "sessions": 1}):
+            sessions = user.get("sessions", [])
+            if "sessions" not in projection:
+                user = {field: value for field, value in user.items() if field != "sessions"}
+            for session_id in sessions:
+                if session_id in found and found[session_id] is None:
+                    found[session_id] = user
+        
+        # The cache and every session get their own copy, as one user may serve several of the sessions
+        with _USER_CACHE_LOCK:
+            for session_id, user in found.items():
+                cls._fill_cache(session_id, key, user, stamp)
+        for session_id, user in found.items():
+            users[session_id] = copy.deepcopy(user)
+        return users
+    
+    @classmethod
+    def add_message_to_conversation(cls, session_id: str, message: Dict[str, Any],
+                                    summary_updates: Optional[Dict[str, Any]] = None) -> int:
         """
         Add a message to the user's conversation history.
+        Summary state changes for the message are applied in the same update.
         Creates a temporary user if no existing user found.
+        Returns the new number of messages, or 0 if nothing was stored.
         """
-        # Find the user by session ID
-        user = cls.find_user({"session_id": session_id})
+        cls.invalidate_cache(session_id)
+        now = datetime.now(timezone.utc)
         
         # Add timestamp to message if not present
         if "timestamp" not in message:
-            message["timestamp"] = datetime.now().isoformat()
+            message["timestamp"] = now
         
         collection = cls.get_collection()
         if collection is None:
             logger.warning("MongoDB not available, cannot update conversation")
-            return False
-        
-        if user:
-            # User exists, update conversation
-            result = collection.update_one(
-                {"_id": user["_id"]},
-                {
-                    "$push": {"conversation": message},
-                    "$set": {"last_active": datetime.now().isoformat()}
+            return 0
+        
+        # Update conversation and the incremental summary state
+        update_fields = {"last_active": now}
+        for key, value in (summary_updates or {}).items():
+            update_fields[f"summary_state.{key}"] = value
+        
+        # Finds the session's user and updates it in one atomic round-trip. If there is none yet, a
+        # temporary one is created with just the session ID; the proper user profile will be created
+        # when phone/cookie is available
+        updated = collection.find_one_and_update(
+            {"sessions": session_id},
+            {
+                "$push": {"conversation": {"$each": [message], "$slice": -cls.CONVERSATION_MAXLEN}},
+                "$set": update_fields,
+                "$inc": {"summary_state.version": 1, "message_count": 1},
+                "$setOnInsert": {
+                    "created_at": now,
+                    "sessions": [session_id],
+                    "documents": [],
+                    "is_temporary": True  # Mark as temporary until properly identified
                 }
-            )
-            return result.modified_count > 0
-        else:
-            # No user found, create a temporary one with just the session ID
-            # The proper user profile will be created when phone/cookie is available
-            new_user = {
-                "created_at": datetime.now().isoformat(),
-                "last_active": datetime.now().isoformat(),
-                "sessions": [session_id],
-                "conversation": [message],
-                "documents": [],
-                "is_temporary": True  # Mark as temporary until properly identified
-            }
-            result = collection.insert_one(new_user)
-            logger.info(f"Created temporary user profile for session {session_id}")
-            return result.inserted_id is not None
+            },
+            projection={"message_count": 1},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        return updated.get("message_count", 0) if updated else 0
     
     @classmethod
-    def update_document_info(cls, session_id: str, document_info: Dict[str, Any]) -> Union[str, bool]:
-        """
-        Store document information and link to user.
-        Uses user_id instead of session_id for the relationship.
-        """
-        # Find the user first
-        user = cls.find_user({"session_id": session_id})
-        if not user:
-            logger.warning(f"No user found for session {session_id}, cannot update document")
+    def set_summary_state(cls, session_id: str, state: Dict[str, Any]) -> bool:
+        """Replace the stored summary state, e.g. after rebuilding it from recent history."""
+        cls.invalidate_cache(session_id)
+        user = cls.find_user({"session_id": session_id}, {"summary_state.version": 1})
+        collection = cls.get_collection()
+        if not user or collection is None:
             return False
-            
-        # Get collections
+        
+        result = collection.update_one(
+            {"_id": user["_id"]},
+            {"$set": {"summary_state": {**state, "version": user.get("summary_state", {}).get("version", 0)}}}
+        )
+        return result.modified_count > 0
+    
+    @classmethod
+    def update_context_summary(cls, session_id: str, summary: str, short_context: Optional[str] = None) -> bool:
+        """Store the formatted context summary used when the user reconnects."""
+        cls.invalidate_cache(session_id)
         collection = cls.get_collection()
-        doc_collection = cls.get_documents_collection()
-        if collection is None or doc_collection is None:
-            logger.warning("MongoDB not available, cannot update document info")
+        if collection is None:
+            logger.warning(f"Cannot update context summary for session {session_id}")
             return False
         
-        # Add timestamp and user ID reference
-        now = datetime.now().isoformat()
+        update_fields = {
+            "context_summary": summary,
+            "context_updated_at": datetime.now(timezone.utc)
+        }
+        if short_context is not None:
+            update_fields["short_context"] = short_context
+        
+        result = collection.update_one({"sessions": session_id}, {"$set": update_fields})
+        return result.modified_count > 0
+    
+    @staticmethod
+    def _document_update(document_info: Dict[str, Any], now: datetime) -> Dict[str, Any]:
+        """Build the user update that links a document to the user."""
+        # Add timestamp
         document_info["updated_at"] = now
-        document_info["user_id"] = user["_id"]  # Use ObjectId reference
         
         # Create a unique document ID if not provided
         if "document_id" not in document_info:
             document_info["document_id"] = f"doc_{ObjectId()}"
         
-        # Store the document
-        doc_result = doc_collection.update_one(
-            {"document_id": document_info["document_id"]},
-            {"$set": document_info},
-            upsert=True
-        )
-        
         # Link document to user
         doc_reference = {
             "document_id": document_info["document_id"],
@@ -241,43 +499,64 @@ class UserProfile:
             "uploaded_at": now
         }
         
-        # Update user's documents array
-        result = collection.update_one(
-            {"_id": user["_id"]},
-            {
-                "$addToSet": {"documents": doc_reference},
-                "$set": {
-                    "last_active": now,
-                    "document_status": document_info.get("status", "pending")
-                }
+        return {
+            "$addToSet": {"documents": doc_reference},
+            "$set": {
+                "last_active": now,
+                "document_status": document_info.get("status", "pending")
             }
+        }
+    
+    @classmethod
+    def _store_document(cls, user_id: ObjectId, document_info: Dict[str, Any]):
+        """Write a document to the documents collection."""
+        document_info["user_id"] = user_id  # Use ObjectId reference
+        cls.get_documents_collection().update_one(
+            {"document_id": document_info["document_id"]},
+            {"$set": document_info},
+            upsert=True
         )
-        
-        if doc_result.upserted_id or doc_result.modified_count > 0:
-            logger.info(f"Document {document_info['document_id']} saved for user {user['_id']}")
-            return document_info["document_id"]
-        
-        return False
     
     @classmethod
-    def update_payment_info(cls, session_id: str, payment_info: Dict[str, Any]) -> Union[str, bool]:
+    def _link_document(cls, session_id: str, document_info: Dict[str, Any], user_update: Dict[str, Any],
+                       projection: Dict[str, Any]) -> Optional[Dict[str, Any]]:
         """
-        Store payment information.
-        Uses user_id instead of session_id for the relationship.
+        Apply a document-linking update to the session's user and store the document.
+        When the user's _id is already cached the document write runs alongside the user update,
+        otherwise it waits for the _id the update returns. Returns the updated user or None.
         """
-        # Find the user first
-        user = cls.find_user({"session_id": session_id})
+        with _USER_CACHE_LOCK:
+            known_id = _USER_ID_CACHE.get((("sessions", session_id),))
+        pending = None
+        if known_id is not None:
+            pending = _DOCUMENT_WRITER.submit(cls._store_document, known_id, dict(document_info))
+        
+        user = cls.get_collection().find_one_and_update(
+            {"sessions": session_id},
+            user_update,
+            projection=projection,
+            return_document=ReturnDocument.AFTER
+        )
+        if pending is not None:
+            pending.result()
+        
         if not user:
-            logger.warning(f"No user found for session {session_id}, cannot update payment")
-            return False
-            
-        collection = cls.get_collection()
-        if collection is None:
-            logger.warning("MongoDB not available, cannot update payment info")
-            return False
+            # Do not leave a document behind for a user that does not exist
+            if pending is not None:
+                cls.get_documents_collection().delete_one({"document_id": document_info["document_id"]})
+            return None
         
+        if user["_id"] == known_id:
+            document_info["user_id"] = known_id
+        else:
+            # Not cached, or the cached _id was stale: write (or overwrite) the document with the real one
+            cls._store_document(user["_id"], document_info)
+        return user
+    
+    @classmethod
+    def _payment_update(cls, payment_info: Dict[str, Any], now: datetime) -> Dict[str, Any]:
+        """Build the user update that records a payment."""
         # Add timestamp
-        now = datetime.now().isoformat()
         payment_info["updated_at"] = now
         
         # Create a unique payment ID if not provided
@@ -293,34 +572,114 @@ class UserProfile:
             "timestamp": now
         }
         
-        # Update the user's payment history
-        result = collection.update_one(
-            {"_id": user["_id"]},
-            {
-                "$push": {"payment_history": payment_record},
-                "$set": {
-                    "current_payment": payment_info,
-                    "last_active": now,
-                    "payment_status": payment_info.get("status", "pending")
-                }
+        update = {
+            "$push": {"payment_history": {"$each": [payment_record], "$slice": -cls.PAYMENT_HISTORY_MAXLEN}},
+            "$set": {
+                "current_payment": payment_info,
+                "last_active": now,
+                "payment_status": payment_info.get("status", "pending")
             }
+        }
+        if payment_info.get("completed") or payment_record["status"] in cls.COMPLETED_PAYMENT_STATUSES:
+            update["$push"]["completed_payments"] = payment_record
+        return update
+    
+    @classmethod
+    def update_document_info(cls, session_id: str, document_info: Dict[str, Any]) -> Union[str, bool]:
+        """
+        Store document information and link to user.
+        Uses user_id instead of session_id for the relationship.
+        """
+        cls.invalidate_cache(session_id)
+        # Get collections
+        collection = cls.get_collection()
+        doc_collection = cls.get_documents_collection()
+        if collection is None or doc_collection is None:
+            logger.warning("MongoDB not available, cannot update document info")
+            return False
+        
+        # Link the document to the session's user and store it under that user's _id
+        user = cls._link_document(
+            session_id, document_info, cls._document_update(document_info, datetime.now(timezone.utc)), {"_id": 1}
         )
+        if not user:
+            logger.warning(f"No user found for session {session_id}, cannot update document")
+            return False
+        
+        logger.info(f"Document {document_info['document_id']} saved for user {user['_id']}")
+        return document_info["document_id"]
+    
+    @classmethod
+    def update_payment_info(cls, session_id: str, payment_info: Dict[str, Any]) -> Union[str, bool]:
+        """
+        Store payment information.
+        Uses user_id instead of session_id for the relationship.
+        """
+        cls.invalidate_cache(session_id)
+        collection = cls.get_collection()
+        if collection is None:
+            logger.warning("MongoDB not available, cannot update payment info")
+            return False
+        
+        # Update the payment history of the session's user
+        result = collection.update_one(
+            {"sessions": session_id},
+            cls._payment_update(payment_info, datetime.now(timezone.utc))
+        )
+        
+        if result.matched_count == 0:
+            logger.warning(f"No user found for session {session_id}, cannot update payment")
+            return False
         
         if result.modified_count > 0:
-            logger.info(f"Payment {payment_info['payment_id']} recorded for user {user['_id']}")
+            logger.info(f"Payment {payment_info['payment_id']} recorded for session {session_id}")
             return payment_info["payment_id"]
         
         return False
     
+    @classmethod
+    def record_document_approval(cls, session_id: str, document_info: Dict[str, Any],
+                                 payment_info: Optional[Dict[str, Any]] = None,
+                                 message: Optional[Dict[str, Any]] = None,
+                                 summary_updates: Optional[Dict[str, Any]] = None) -> int:
+        """
+        Store a verified document together with the payment link offered for it and the message announcing it.
+        All changes to the user go out in one update instead of one round-trip each.
+        Returns the new number of messages, or 0 if nothing was stored.
+        """
+        cls.invalidate_cache(session_id)
+        collection = cls.get_collection()
+        doc_collection = cls.get_documents_collection()
+        if collection is None or doc_collection is None:
+            logger.warning("MongoDB not available, cannot record document approval")
+            return 0
+        
+        now = datetime.now(timezone.utc)
+        user_update = cls._document_update(document_info, now)
+        
+        if payment_info is not None:
+            for operator, fields in cls._payment_update(payment_info, now).items():
+                user_update.setdefault(operator, {}).update(fields)
+        
+        if message is not None:
+            message.setdefault("timestamp", now)
+            user_update.setdefault("$push", {})["conversation"] = {"$each": [message], "$slice": -cls.CONVERSATION_MAXLEN}
+            for key, value in (summary_updates or {}).items():
+                user_update["$set"][f"summary_state.{key}"] = value
+            user_update["$inc"] = {"summary_state.version": 1, "message_count": 1}
+        
+        updated = cls._link_document(session_id, document_info, user_update, {"message_count": 1})
+        if not updated:
+            logger.warning(f"No user found for session {session_id}, cannot record document approval")
+            return 0
+        
+        logger.info(f"Document {document_info['document_id']} approved for user {updated['_id']}")
+        return updated.get("message_count", 0)
+    
     @classmethod
     def mark_case_outcome(cls, session_id: str, is_win: bool, reason: Optional[str] = None) -> bool:
         """Mark a case as won (payment completed) or lost (dropped off)."""
-        # Find the user first
-        user = cls.find_user({"session_id": session_id})
-        if not user:
-            logger.warning(f"No user found for session {session_id}, cannot mark case outcome")
-            return False
-            
+        cls.invalidate_cache(session_id)
         collection = cls.get_collection()
         if collection is None:
             logger.warning("MongoDB not available, cannot update case outcome")
@@ -329,7 +688,7 @@ class UserProfile:
         update_data = {
             "case_outcome": {
                 "is_win": is_win,
-                "timestamp": datetime.now().isoformat()
+                "timestamp": datetime.now(timezone.utc)
             }
         }
         
@@ -337,10 +696,14 @@ class UserProfile:
             update_data["case_outcome"]["reason"] = reason
         
         result = collection.update_one(
-            {"_id": user["_id"]},
+            {"sessions": session_id},
             {"$set": update_data}
         )
         
+        if result.matched_count == 0:
+            logger.warning(f"No user found for session {session_id}, cannot mark case outcome")
+            return False
+        
         return result.modified_count > 0
     
     @classmethod
@@ -349,43 +712,32 @@ class UserProfile:
         Legacy method for compatibility with existing code.
         Creates or updates a user by session ID.
         """
-        # Get or create user
-        user = cls.find_user({"session_id": session_id})
-        
-        # If we find a user, update it
-        if user:
-            return cls.create_or_update_user({"session_id": session_id}, data)
-        else:
-            # Create new user with just session ID
-            return cls.create_or_update_user({"session_id": session_id}, data)
+        # create_or_update_user finds the user itself and creates it if needed
+        return cls.create_or_update_user({"session_id": session_id}, data)
     
     @classmethod
     def has_completed_payment(cls, user_identifier: Dict[str, Any]) -> bool:
         """
-        Check if a user has already completed payment based on their identifier.
+        Check if the user behind any of the identifiers has already completed payment.
         Returns True if payment is completed, False otherwise.
         """
-        # Find the user first
-        user = cls.find_user(user_identifier)
-        if not user:
+        queries = cls._identifier_queries(user_identifier)
+        collection = cls.get_collection()
+        if not queries or collection is None:
             return False
-            
-        # Check if payment is completed
-        if "payment_status" in user and user["payment_status"] == "completed":
-            return True
-            
-        # Check payment history
-        if "payment_history" in user and user["payment_history"]:
-            for payment in user["payment_history"]:
-                if payment.get("status") == "completed" or payment.get("status") == "captured":
-                    return True
-                    
-        # Check current payment
-        if "current_payment" in user and user["current_payment"]:
-            if user["current_payment"].get("status") == "completed" or user["current_payment"].get("status") == "captured":
-                return True
-                
-        return False
+        
+        # One indexed query answers it: any user behind the identifiers with a completed payment
+        paid = {"$in": cls.COMPLETED_PAYMENT_STATUSES}
+        return collection.find_one(
+            {"$and": [
+                {"$or": queries},
+                {"$or": [
+                    {"payment_status": "completed"}, {"completed_payments.0": {"$exists": True}},
+                    {"payment_history.status": paid}, {"current_payment.status": paid}
+                ]}
+            ]},
+            {"_id": 1}
+        ) is not None
         
     @classmethod
     def set_user_identifier(cls, session_id: str, identifier: Dict[str, Any]) -> bool:
@@ -393,6 +745,7 @@ class UserProfile:
         Update user identification info (device_id, phone, email, name, cookie_id).
         If a user with this identifier already exists, the sessions will be merged.
         """
+        cls.invalidate_cache(session_id)
         # Get collections
         collection = cls.get_collection()
         if collection is None:
@@ -408,7 +761,7 @@ class UserProfile:
         
         # Then check phone
         if not existing_user and "phone" in identifier and identifier["phone"]:
-            phone = re.sub(r'[^0-9+]', '', identifier["phone"])
+            phone = PHONE_STRIP_RE.sub('', identifier["phone"])
             existing_user = collection.find_one({"phone": phone})
             
         # Finally check cookie ID
@@ -416,18 +769,18 @@ class UserProfile:
             existing_user = collection.find_one({"cookie_id": identifier["cookie_id"]})
         
         # Get current user by session ID
-        current_user = cls.find_user({"session_id": session_id})
+        current_user = cls.find_user({"session_id": session_id}, {"_id": 1})
         
         # If we have both an existing user and a current user, and they're different, merge them
         if existing_user and current_user and str(existing_user["_id"]) != str(current_user["_id"]):
             # Merge the two users
             return cls.merge_users(current_user["_id"], existing_user["_id"], session_id)
         elif current_user:
-            # Just update the current user with the new identifier
-            update_data = {}
+            # Just update the current user with the new identifier; giving one is user activity
+            update_data = {"last_active": datetime.now(timezone.utc)}
             
             if "phone" in identifier and identifier["phone"]:
-                update_data["phone"] = re.sub(r'[^0-9+]', '', identifier["phone"])
+                update_data["phone"] = PHONE_STRIP_RE.sub('', identifier["phone"])
                 
             if "cookie_id" in identifier and identifier["cookie_id"]:
                 update_data["cookie_id"] = identifier["cookie_id"]
@@ -442,6 +795,7 @@ class UserProfile:
                 {"_id": current_user["_id"]},
                 {"$set": update_data}
             )
+            cls._forget_user_ids([identifier], current_user["_id"])
             
             logger.info(f"Updated user {current_user['_id']} with identifier {identifier}")
             return result.modified_count > 0
@@ -452,75 +806,79 @@ class UserProfile:
                 identifier
             ) is not None
     
+    @staticmethod
+    def _append_missing(field: str, key: str, items: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Aggregation expression appending the items whose key is not yet in the array field."""
+        return {"$concatArrays": [
+            {"$ifNull": [f"${field}", []]},
+            {"$filter": {
+                "input": {"$literal": items},
+                "cond": {"$not": [{"$in": [f"$$this.{key}", {"$ifNull": [f"${field}.{key}", []]}]}]}
+            }}
+        ]}
+    
     @classmethod
     def merge_users(cls, from_user_id: ObjectId, to_user_id: ObjectId, current_session_id: str) -> bool:
         """
         Merge conversation history, documents, and payments from one user to another.
         Used when we discover that a temporary user is actually a returning user.
         """
+        cls.invalidate_cache()
         # Get collection
         collection = cls.get_collection()
         if collection is None:
             logger.warning("MongoDB not available, cannot merge users")
             return False
             
-        # Get both users
-        from_user = collection.find_one({"_id": from_user_id})
-        to_user = collection.find_one({"_id": to_user_id})
-        
-        if not from_user or not to_user:
-            logger.warning(f"Cannot merge users: one or both users not found")
+        # Only the source user is read; the merge into the target happens on the server
+        from_user = collection.find_one({"_id": from_user_id}, {
+            "sessions": 1, "conversation": 1, "message_count": 1, "documents": 1, "payment_history": 1,
+            "completed_payments": 1, "document_status": 1, "payment_status": 1, "current_payment": 1
+        })
+        
+        if not from_user:
+            logger.warning(f"Cannot merge users: user {from_user_id} not found")
             return False
-            
-        # Merge sessions
-        merged_sessions = list(set(from_user.get("sessions", []) + to_user.get("sessions", [])))
-        
-        # Merge conversation (maintaining order by timestamp)
-        merged_conversation = from_user.get("conversation", []) + to_user.get("conversation", [])
-        if merged_conversation:
-            # Sort by timestamp if available
-            merged_conversation.sort(key=lambda msg: msg.get("timestamp", ""), reverse=False)
-        
-        # Merge documents
-        merged_documents = to_user.get("documents", [])
-        for doc in from_user.get("documents", []):
-            if not any(d["document_id"] == doc["document_id"] for d in merged_documents):
-                merged_documents.append(doc)
-        
-        # Merge payment history
-        merged_payment_history = to_user.get("payment_history", [])
-        for payment in from_user.get("payment_history", []):
-            if not any(p["payment_id"] == payment["payment_id"] for p in merged_payment_history):
-                merged_payment_history.append(payment)
-        
-        # Use most recent document and payment status
-        document_status = from_user.get("document_status", to_user.get("document_status", "pending"))
-        payment_status = from_user.get("payment_status", to_user.get("payment_status", "pending"))
-        
-        # Take the most recent payment as current
-        current_payment = from_user.get("current_payment", to_user.get("current_payment", None))
         
-        # Update the target user with merged data
-        update_result = collection.update_one(
-            {"_id": to_user_id},
-            {
-                "$set": {
-                    "sessions": merged_sessions,
-                    "conversation": merged_conversation,
-                    "documents": merged_documents,
-                    "payment_history": merged_payment_history,
-                    "document_status": document_status,
-                    "payment_status": payment_status,
-                    "last_active": datetime.now().isoformat()
-                }
-            }
-        )
-        
-        if current_payment:
-            collection.update_one(
-                {"_id": to_user_id},
-                {"$set": {"current_payment": current_payment}}
+        from_conversation = from_user.get("conversation", [])
+        
+        # Documents and payments, fields whose value comes from the source user when it has one
+        merged_fields = {
+            "documents": cls._append_missing("documents", "document_id", from_user.get("documents", [])),
+            "payment_history": {"$slice": [
+                cls._append_missing("payment_history", "payment_id", from_user.get("payment_history", [])),
+                -cls.PAYMENT_HISTORY_MAXLEN
+            ]},
+            "completed_payments": cls._append_missing(
+                "completed_payments", "payment_id", from_user.get("completed_payments", [])
+            ),
+            # Both users' messages count towards the merged total
+            "message_count": {"$add": [cls.CONVERSATION_LENGTH, from_user.get("message_count", len(from_conversation))]}
+        }
+        for field in ("document_status", "payment_status"):
+            merged_fields[field] = (
+                {"$literal": from_user[field]} if field in from_user else {"$ifNull": [f"${field}", "pending"]}
             )
+        # Take the most recent payment as current
+        if from_user.get("current_payment"):
+            merged_fields["current_payment"] = {"$literal": from_user["current_payment"]}
+        
+        # Both updates go out in one request: the pipeline reads the target's own message count before
+        # the conversations are merged, keeping the newest messages in timestamp order
+        update_result = collection.bulk_write([
+            UpdateOne({"_id": to_user_id}, [{"$set": merged_fields}]),
+            UpdateOne({"_id": to_user_id}, {
+                "$addToSet": {"sessions": {"$each": from_user.get("sessions", [])}},
+                "$push": {"conversation": {
+                    "$each": from_conversation, "$sort": {"timestamp": 1}, "$slice": -cls.CONVERSATION_MAXLEN
+                }},
+                "$set": {"last_active": datetime.now(timezone.utc)}
+            })
+        ])
+        
+        if update_result.matched_count == 0:
+            logger.warning(f"Cannot merge users: user {to_user_id} not found")
+            return False
         
         # Delete the source user
         collection.delete_one({"_id": from_user_id})
@@ -532,14 +890,6 @@ class UserProfile:
     def mongo_to_json_serializable(obj):
         """
         Convert MongoDB objects to JSON serializable format.
+        The document is walked by orjson in C: datetimes become ISO strings and ObjectIds plain strings.
         """
-        if isinstance(obj, ObjectId):
-            return str(obj)
-        elif isinstance(obj, datetime):
-            return obj.isoformat()
-        elif isinstance(obj, dict):
-            return {k: UserProfile.mongo_to_json_serializable(v) for k, v in obj.items()}
-        elif isinstance(obj, list):
-            return [UserProfile.mongo_to_json_serializable(item) for item in obj]
-        else:
-            return obj
\ No newline at end of file
+        return orjson.loads(orjson.dumps(obj, default=_bson_default, option=orjson.OPT_NON_STR_KEYS))
\ No newline at end of file
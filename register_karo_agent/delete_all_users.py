@@ -43,9 +43,6 @@ def delete_all_users():
     
     logger.info(f"Deleted {users_deleted} users and {docs_deleted} user documents")
     
-    # Close connection
-    mongo_db.close()
-    
     return users_deleted, docs_deleted
 
 # Immediately execute the function
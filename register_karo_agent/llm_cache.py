@@ -0,0 +1,66 @@
+"""
+LLM response cache - serves repeated opening questions without another LLM round-trip
+"""
+import os
+import json
+import hashlib
+import logging
+from typing import Any, Dict, Optional
+from cachetools import TTLCache
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+class LLMCache:
+    """
+    Exact-match cache for agent responses to turns that do not depend on session state.
+    Keys are a SHA-256 hash of the agent name, the normalized user message and any
+    other inputs the answer depends on (such as the language), never the full prompt,
+    which carries per-session IDs and history. Entries expire after a short TTL to keep answers fresh.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: int = 300):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize_message(message: str) -> str:
+        """Lowercase and collapse whitespace so case and formatting differences hit the same entry."""
+        return " ".join(message.lower().split())
+
+    def cache_key(self, agent_name: str, message: str, **params: Any) -> str:
+        """Build the cache key for an agent's answer to a user message."""
+        payload = {"agent": agent_name, "message": self.normalize_message(message), **params}
+        return hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Return the cached entry for a key, or None on a miss."""
+        entry = self._cache.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        logger.info(f"LLM cache hit ({self.hits} hits / {self.misses} misses)")
+        return entry
+
+    async def set(self, key: str, value: Dict[str, Any]):
+        """Store an entry for a key."""
+        self._cache[key] = value
+
+    def clear(self):
+        """Drop all cached entries."""
+        self._cache.clear()
+
+def result_is_cacheable(result: Any) -> bool:
+    """
+    Only plain text answers are safe to replay.
+    Runs that called tools (payment links, status checks) have side effects and are never cached.
+    """
+    return not any(getattr(item, "type", None) == "tool_call_item" for item in getattr(result, "new_items", []))
+
+# Shared cache instance
+llm_cache = LLMCache(
+    maxsize=int(os.environ.get("LLM_CACHE_SIZE", "1024")),
+    ttl=int(os.environ.get("LLM_CACHE_TTL", "300"))
+)
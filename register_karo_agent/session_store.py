@@ -0,0 +1,288 @@
+"""
+Session store - one interface over the MongoDB user profiles and the in-memory fallback
+"""
+import asyncio
+import copy
+import json
+import logging
+from collections import deque
+from itertools import islice
+from typing import Any, Deque, Dict, List, Optional, Protocol, Set
+
+try:
+    from database.models import UserProfile
+except ImportError:
+    UserProfile = None
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+class SessionStore(Protocol):
+    """
+    Storage operations the chat flow needs for a session.
+    Records are user-document shaped dicts: profile fields at the top level plus
+    "document", "payment", "thread_id", "context_summary" and "short_context" when set.
+    The full conversation is never loaded; only its tail or its length are read.
+    """
+
+    async def get(self, session_id: str, fields: Optional[List[str]] = None,
+                  history_limit: int = 0) -> Optional[Dict[str, Any]]:
+        """
+        Get the record for a session, or None if the session is unknown.
+        If fields are given only those need to be returned; "message_count" and
+        "summary_state" are only included when asked for.
+        With history_limit, the whole record plus the last history_limit messages
+        (as "conversation") is returned in the same read.
+        """
+        ...
+
+    async def recent_messages(self, session_id: str, limit: int) -> List[Dict[str, Any]]:
+        """Get the last `limit` messages of the conversation."""
+        ...
+
+    async def append_message(self, session_id: str, message: Dict[str, Any],
+                             summary_updates: Optional[Dict[str, Any]] = None) -> int:
+        """Append a message, apply its changes to the summary state and return the new message count."""
+        ...
+
+    async def update_user(self, session_id: str, data: Dict[str, Any]):
+        """Set top-level profile fields."""
+        ...
+
+    async def get_payment(self, session_id: str) -> Dict[str, Any]:
+        """Get the stored payment information, or an empty dict if there is none."""
+        ...
+
+    async def update_payment(self, session_id: str, payment_info: Dict[str, Any]):
+        """Store payment information."""
+        ...
+
+    async def set_summary_state(self, session_id: str, state: Dict[str, Any]):
+        """Replace the summary state."""
+        ...
+
+    async def update_context_summary(self, session_id: str, summary: str, short_context: Optional[str] = None):
+        """Store the formatted context summary."""
+        ...
+
+    async def has_completed_payment(self, session_id: str, cookie_id: Optional[str] = None,
+                                    device_id: Optional[str] = None) -> bool:
+        """Check if the user behind any of the identifiers has completed payment."""
+        ...
+
+class SessionLookupBatcher:
+    """
+    Coalesces concurrent reads of the same fields for different sessions into one query.
+    Lookups made during one event loop iteration are sent together at the start of the next.
+    """
+
+    def __init__(self):
+        # projection key -> (projection, session_id -> futures waiting for that session)
+        self._pending: Dict[str, tuple] = {}
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def get(self, session_id: str, projection: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Get the projected fields of the user for a session, batched with concurrent lookups."""
+        loop = asyncio.get_running_loop()
+        key = json.dumps(projection, sort_keys=True)
+        if key not in self._pending:
+            self._pending[key] = (projection, {})
+            loop.call_soon(self._flush, key)
+        future = loop.create_future()
+        self._pending[key][1].setdefault(session_id, []).append(future)
+        return await future
+
+    def _flush(self, key: str):
+        projection, waiters = self._pending.pop(key)
+        task = asyncio.ensure_future(self._load(projection, waiters))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _load(self, projection: Dict[str, Any], waiters: Dict[str, List[asyncio.Future]]):
+        try:
+            users = await asyncio.to_thread(UserProfile.get_fields_many, list(waiters), projection)
+        except Exception as e:
+            for futures in waiters.values():
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+            return
+        for session_id, futures in waiters.items():
+            user = users.get(session_id)
+            for future in futures:
+                if not future.done():
+                    # Every caller gets its own copy, as with UserProfile.get_fields
+                    future.set_result(copy.deepcopy(user))
+
+class MongoSessionStore:
+    """
+    Session store backed by the UserProfile collection.
+    PyMongo is synchronous, so every call runs in a worker thread to keep the event loop free.
+    """
+
+    # Fields never needed when a caller asks for the whole record; the arrays grow with the user's history
+    EXCLUDED_FIELDS = {"conversation": 0, "summary_state": 0, "sessions": 0, "payment_history": 0,
+                       "completed_payments": 0, "documents": 0}
+
+    def __init__(self):
+        self._lookups = SessionLookupBatcher()
+
+    async def get(self, session_id: str, fields: Optional[List[str]] = None,
+                  history_limit: int = 0) -> Optional[Dict[str, Any]]:
+        if history_limit:
+            projection = {**self.EXCLUDED_FIELDS, "conversation": {"$slice": -history_limit}}
+            return await asyncio.to_thread(UserProfile.get_fields, session_id, projection)
+        if fields is None:
+            return await asyncio.to_thread(UserProfile.get_fields, session_id, self.EXCLUDED_FIELDS)
+
+        projection = {field: 1 for field in fields if field != "message_count"}
+        if "message_count" in fields:
+            projection["message_count"] = UserProfile.CONVERSATION_LENGTH
+        # Field lookups are the per-turn reads, so concurrent sessions share one query
+        return await self._lookups.get(session_id, projection)
+
+    async def recent_messages(self, session_id: str, limit: int) -> List[Dict[str, Any]]:
+        user_data = await asyncio.to_thread(UserProfile.get_fields, session_id, {"conversation": {"$slice": -limit}})
+        return user_data.get("conversation", []) if user_data else []
+
+    async def append_message(self, session_id: str, message: Dict[str, Any],
+                             summary_updates: Optional[Dict[str, Any]] = None) -> int:
+        return await asyncio.to_thread(UserProfile.add_message_to_conversation, session_id, message, summary_updates)
+
+    async def update_user(self, session_id: str, data: Dict[str, Any]):
+        await asyncio.to_thread(UserProfile.create_or_update, session_id, data)
+
+    async def get_payment(self, session_id: str) -> Dict[str, Any]:
+        # update_payment_info keeps the latest payment in current_payment
+        user_data = await self._lookups.get(session_id, {"current_payment": 1})
+        return (user_data or {}).get("current_payment") or {}
+
+    async def update_payment(self, session_id: str, payment_info: Dict[str, Any]):
+        await asyncio.to_thread(UserProfile.update_payment_info, session_id, payment_info)
+
+    async def set_summary_state(self, session_id: str, state: Dict[str, Any]):
+        await asyncio.to_thread(UserProfile.set_summary_state, session_id, state)
+
+    async def update_context_summary(self, session_id: str, summary: str, short_context: Optional[str] = None):
+        await asyncio.to_thread(UserProfile.update_context_summary, session_id, summary, short_context)
+
+    async def has_completed_payment(self, session_id: str, cookie_id: Optional[str] = None,
+                                    device_id: Optional[str] = None) -> bool:
+        identifier = {"session_id": session_id}
+        if cookie_id:
+            identifier["cookie_id"] = cookie_id
+        if device_id:
+            identifier["device_id"] = device_id
+        return await asyncio.to_thread(UserProfile.has_completed_payment, identifier)
+
+def _tail(history: Deque[Dict[str, Any]], limit: int) -> List[Dict[str, Any]]:
+    """Get the last `limit` messages of a history as a list."""
+    return list(islice(history, max(len(history) - limit, 0), None))
+
+class SessionState:
+    """Everything the in-memory fallback keeps for one session."""
+
+    __slots__ = ("history", "user", "document", "payment", "summary_state", "message_count")
+
+    def __init__(self, history_maxlen: int):
+        self.history: Deque[Dict[str, Any]] = deque(maxlen=history_maxlen)
+        self.user: Dict[str, Any] = {}
+        self.document: Optional[Dict[str, Any]] = None
+        self.payment: Optional[Dict[str, Any]] = None
+        self.summary_state: Optional[Dict[str, Any]] = None
+        self.message_count = 0
+
+class InMemorySessionStore:
+    """
+    Session store over the in-memory fallback session table.
+    The table is shared with the caller, so code that still reads it directly sees the same data.
+    Each history keeps only its last HISTORY_MAXLEN messages, so memory per session is bounded;
+    the message count still covers the whole conversation.
+    """
+
+    HISTORY_MAXLEN = 200
+
+    def __init__(self, sessions: Dict[str, SessionState], session_suffixes: Dict[str, str]):
+        self.sessions = sessions
+        self.session_suffixes = session_suffixes
+
+    def session(self, session_id: str) -> SessionState:
+        """Get the state of a session, creating it on first write."""
+        session = self.sessions.get(session_id)
+        if session is None:
+            session = self.sessions[session_id] = SessionState(self.HISTORY_MAXLEN)
+            # Index the new session by its last 8 characters for partial session ID lookups
+            self.session_suffixes.setdefault(session_id[-8:], session_id)
+        return session
+
+    async def get(self, session_id: str, fields: Optional[List[str]] = None,
+                  history_limit: int = 0) -> Optional[Dict[str, Any]]:
+        session = self.sessions.get(session_id)
+        if session is None:
+            return None
+
+        record = dict(session.user)
+        if session.document is not None:
+            record["document"] = session.document
+        if session.payment is not None:
+            record["payment"] = session.payment
+        if history_limit:
+            record["conversation"] = _tail(session.history, history_limit)
+        if fields is not None:
+            if "message_count" in fields:
+                record["message_count"] = session.message_count
+            if "summary_state" in fields and session.summary_state is not None:
+                record["summary_state"] = session.summary_state
+        return record
+
+    async def recent_messages(self, session_id: str, limit: int) -> List[Dict[str, Any]]:
+        session = self.sessions.get(session_id)
+        return _tail(session.history, limit) if session else []
+
+    async def append_message(self, session_id: str, message: Dict[str, Any],
+                             summary_updates: Optional[Dict[str, Any]] = None) -> int:
+        session = self.session(session_id)
+        session.history.append(message)
+
+        if session.summary_state is None:
+            session.summary_state = {}
+        session.summary_state.update(summary_updates or {})
+        session.summary_state["version"] = session.summary_state.get("version", 0) + 1
+
+        session.message_count += 1
+        return session.message_count
+
+    async def update_user(self, session_id: str, data: Dict[str, Any]):
+        self.session(session_id).user.update(data)
+
+    async def get_payment(self, session_id: str) -> Dict[str, Any]:
+        session = self.sessions.get(session_id)
+        return dict(session.payment) if session is not None and session.payment is not None else {}
+
+    async def update_payment(self, session_id: str, payment_info: Dict[str, Any]):
+        session = self.session(session_id)
+        if session.payment is None:
+            session.payment = {}
+        session.payment.update(payment_info)
+
+    async def set_summary_state(self, session_id: str, state: Dict[str, Any]):
+        session = self.session(session_id)
+        version = (session.summary_state or {}).get("version", 0)
+        session.summary_state = {**state, "version": version}
+
+    async def update_context_summary(self, session_id: str, summary: str, short_context: Optional[str] = None):
+        data = {"context_summary": summary}
+        if short_context is not None:
+            data["short_context"] = short_context
+        self.session(session_id).user.update(data)
+
+    async def has_completed_payment(self, session_id: str, cookie_id: Optional[str] = None,
+                                    device_id: Optional[str] = None) -> bool:
+        # First try by cookie ID, then by session ID
+        for key in (cookie_id, session_id):
+            session = self.sessions.get(key) if key else None
+            if session is not None and session.payment is not None:
+                return session.payment.get("completed", False)
+
+        # Device ID is not tracked in memory mode
+        return False
@@ -179,59 +179,66 @@ document.addEventListener('DOMContentLoaded', function() {
             }
         };
         
+        // Handle a single event sent by the server
+        function handleServerEvent(data) {
+            if (data.type === 'session_info') {
+                // Store the server's session ID
+                serverSessionId = data.session_id;
+                updateDebug(`Received server session ID: ${serverSessionId}`);
+                
+                // Check if the server needs us to send a cookie
+                if (data.requires_cookie) {
+                    // Send cookie ID if we have one, otherwise tell server we don't have one
+                    socket.send(JSON.stringify({
+                        type: 'cookie_id',
+                        cookie_id: cookieId || ''
+                    }));
+                    updateDebug(`Sent cookie_id response: ${cookieId || '(none)'}`);
+                }
+            } else if (data.type === 'set_cookie') {
+                // Server is asking us to set a new cookie
+                cookieId = data.cookie_id;
+                setCookie('registerKaroCookieId', cookieId, cookieLifetime);
+                updateDebug(`Set new cookie ID: ${cookieId}`);
+                
+                // Also store in user info for redundancy
+                let userInfo;
+                try {
+                    userInfo = JSON.parse(localStorage.getItem('userInfo') || '{}');
+                    userInfo.cookieId = cookieId;
+                    localStorage.setItem('userInfo', JSON.stringify(userInfo));
+                } catch (e) {
+                    console.error('Error updating user info with cookie:', e);
+                }
+            } else if (data.type === 'message' || data.type === 'follow_up') {
+                updateDebug(`Adding message to chat: ${data.text.substring(0, 30)}...`);
+                addMessage(data.text, 'bot', data.type);
+                resetFollowUpCount();
+                
+                // Auto-close payment area if payment confirmation message is received
+                if (data.type === 'message' && 
+                    (data.text.includes("payment has been successfully received") || 
+                     data.text.includes("Payment successful") || 
+                     data.text.includes("payment confirmed"))) {
+                    closePaymentArea();
+                }
+            } else if (data.type === 'show_document_upload') {
+                showDocumentUploadForm();
+                updateDebug('Showing document upload form');
+            } else if (data.type === 'payment_link') {
+                showPaymentLink(data.link);
+                updateDebug(`Showing payment link: ${data.link}`);
+            }
+        }
+        
         socket.onmessage = function(event) {
             try {
                 const data = JSON.parse(event.data);
                 updateDebug(`Received message of type: ${data.type}`);
                 
-                if (data.type === 'session_info') {
-                    // Store the server's session ID
-                    serverSessionId = data.session_id;
-                    updateDebug(`Received server session ID: ${serverSessionId}`);
-                    
-                    // Check if the server needs us to send a cookie
-                    if (data.requires_cookie) {
-                        // Send cookie ID if we have one, otherwise tell server we don't have one
-                        socket.send(JSON.stringify({
-                            type: 'cookie_id',
-                            cookie_id: cookieId || ''
-                        }));
-                        updateDebug(`Sent cookie_id response: ${cookieId || '(none)'}`);
-                    }
-                } else if (data.type === 'set_cookie') {
-                    // Server is asking us to set a new cookie
-                    cookieId = data.cookie_id;
-                    setCookie('registerKaroCookieId', cookieId, cookieLifetime);
-                    updateDebug(`Set new cookie ID: ${cookieId}`);
-                    
-                    // Also store in user info for redundancy
-                    let userInfo;
-                    try {
-                        userInfo = JSON.parse(localStorage.getItem('userInfo') || '{}');
-                        userInfo.cookieId = cookieId;
-                        localStorage.setItem('userInfo', JSON.stringify(userInfo));
-                    } catch (e) {
-                        console.error('Error updating user info with cookie:', e);
-                    }
-                } else if (data.type === 'message' || data.type === 'follow_up') {
-                    updateDebug(`Adding message to chat: ${data.text.substring(0, 30)}...`);
-                    addMessage(data.text, 'bot', data.type);
-                    resetFollowUpCount();
-                    
-                    // Auto-close payment area if payment confirmation message is received
-                    if (data.type === 'message' && 
-                        (data.text.includes("payment has been successfully received") || 
-                         data.text.includes("Payment successful") || 
-                         data.text.includes("payment confirmed"))) {
-                        closePaymentArea();
-                    }
-                } else if (data.type === 'show_document_upload') {
-                    showDocumentUploadForm();
-                    updateDebug('Showing document upload form');
-                } else if (data.type === 'payment_link') {
-                    showPaymentLink(data.link);
-                    updateDebug(`Showing payment link: ${data.link}`);
-                }
+                // A batch carries several events from one turn; handle them in order
+                const events = data.type === 'batch' ? data.events : [data];
+                events.forEach(handleServerEvent);
             } catch (error) {
                 updateDebug(`Error parsing WebSocket message: ${error.message}`);
                 console.error('Error parsing WebSocket message:', error);
@@ -1,4 +1,5 @@
 import os
+import asyncio
 import logging
 import cloudinary
 import cloudinary.uploader
@@ -74,9 +75,10 @@ class CloudinaryStorage:
             filename = os.path.basename(file_path)
             public_id = f"{public_id_prefix}/{filename}"
             
-            # Upload file to Cloudinary
+            # Upload file to Cloudinary; the SDK call blocks, so it runs in a worker thread
             logger.info(f"Uploading document to Cloudinary: {filename}")
-            result = cloudinary.uploader.upload(
+            result = await asyncio.to_thread(
+                cloudinary.uploader.upload,
                 file_path,
                 public_id=public_id,
                 resource_type="auto",  # Auto-detect type (image, pdf, etc.)
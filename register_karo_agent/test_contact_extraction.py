@@ -0,0 +1,33 @@
+"""
+Tests for picking contact details out of user messages
+"""
+from contact_extraction import extract_contact_details
+
+def test_name_stops_before_email():
+    """The name does not run on into the rest of the sentence and the email is still found."""
+    assert extract_contact_details("My name is Rahul my email is rahul@example.com") == {
+        "name": "Rahul",
+        "email": "rahul@example.com",
+    }
+
+def test_name_email_and_phone_in_one_message():
+    """A lowercase email local part is not taken as part of the name."""
+    assert extract_contact_details("I am Rahul rahul@example.com 9876543210") == {
+        "name": "Rahul",
+        "email": "rahul@example.com",
+        "phone": "9876543210",
+    }
+
+def test_lowercase_word_is_not_a_name():
+    """'I am interested' is not an introduction."""
+    assert extract_contact_details("I am interested, email me at a@b.com") == {"email": "a@b.com"}
+
+def test_two_word_name():
+    """A first and last name are kept together."""
+    assert extract_contact_details("hi, my name is Rahul Sharma and I need a GST registration") == {
+        "name": "Rahul Sharma",
+    }
+
+def test_no_contact_details():
+    """Nothing is returned for a message without contact details."""
+    assert extract_contact_details("What documents do I need?") == {}
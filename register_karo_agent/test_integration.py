@@ -112,7 +112,7 @@ async def test_user_profile_operations():
         logger.info("Updated context summary")
         
         # Retrieve the user profile
-        user_data = UserProfile.get_by_session(test_session_id)
+        user_data = UserProfile.get_by_session(test_session_id, recent_messages=10)
         if user_data is None:
             logger.error("Failed to retrieve user profile")
             return False
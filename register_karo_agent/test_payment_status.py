@@ -0,0 +1,34 @@
+"""
+Tests for skipping Razorpay status checks when the stored payment is already final
+"""
+import asyncio
+import pytest
+from database.models import UserProfile
+from session_store import MongoSessionStore
+
+def test_mongo_store_reads_current_payment(monkeypatch):
+    """The stored payment is read from current_payment, where update_payment_info writes it."""
+    payment = {"payment_id": "plink_1", "status": "paid", "completed": True}
+    monkeypatch.setattr(
+        UserProfile, "get_fields_many",
+        classmethod(lambda cls, session_ids, projection: {sid: {"current_payment": dict(payment)} for sid in session_ids})
+    )
+
+    async def read():
+        return await MongoSessionStore().get_payment("session_1")
+
+    assert asyncio.run(read()) == payment
+
+def test_final_status_skips_razorpay(monkeypatch):
+    """A payment already stored as paid is not checked with Razorpay again."""
+    app = pytest.importorskip("app")
+    checked = []
+
+    async def get_payment(session_id):
+        return {"payment_id": "plink_1", "status": "paid", "completed": True}
+
+    monkeypatch.setattr(app.store, "get_payment", get_payment)
+    monkeypatch.setattr(app, "check_payment_status", lambda payment_id: checked.append(payment_id))
+
+    asyncio.run(app._handle_verify_payment_status("session_1", [], {"arguments": {"payment_id": "plink_1"}}))
+    assert checked == []
@@ -1,5 +1,7 @@
 import os
+import re
 import base64
+import asyncio
 import logging
 import mimetypes
 from typing import Dict, Any, Optional
@@ -41,13 +43,43 @@ SUPPORTED_FORMATS = [
     "application/pdf"  # Added PDF support
 ]
 
-async def verify_document_with_vision(document_url: str, session_id: Optional[str] = None) -> Dict[str, Any]:
+# Keyword sets used to judge the vision analysis, compiled once
+VALID_RE = re.compile(r"valid|acceptable|good quality")
+CLARITY_RE = re.compile(r"clear|legible|readable")
+PROBLEM_RE = re.compile(r"blurry|unclear|cannot read|illegible|fake|forged|manipulated")
+
+# Shared OpenAI client, configured once by the app so connections are pooled
+_openai_client: Optional[AsyncOpenAI] = None
+
+def set_openai_client(client: AsyncOpenAI):
+    """Use the given client (with a pooled HTTP transport) for all vision calls."""
+    global _openai_client
+    _openai_client = client
+
+def get_openai_client() -> AsyncOpenAI:
+    """Return the shared OpenAI client, creating it on first use if none was configured."""
+    global _openai_client
+    if _openai_client is None:
+        api_key = os.environ.get("OPENAI_API_KEY")
+        if not api_key:
+            raise ValueError("OPENAI_API_KEY environment variable is not set")
+        _openai_client = AsyncOpenAI(api_key=api_key)
+    return _openai_client
+
+def read_base64(file_path: str) -> str:
+    """Read a file and return its contents base64-encoded."""
+    with open(file_path, "rb") as file:
+        return base64.b64encode(file.read()).decode('utf-8')
+
+async def verify_document_with_vision(document_url: str, session_id: Optional[str] = None,
+                                     upload_to_cloudinary: bool = True) -> Dict[str, Any]:
     """
     Verify a document using OpenAI's Vision API and store it in Cloudinary.
     
     Args:
         document_url: URL or file path to the document image or PDF
         session_id: User's session ID for database persistence
+        upload_to_cloudinary: Set to False when the caller uploads the document itself
         
     Returns:
         Dictionary containing verification results
@@ -55,13 +87,8 @@ async def verify_document_with_vision(document_url: str, session_id: Optional[st
     logger.info(f"Verifying document: {document_url}")
     
     try:
-        # Get the API key from environment
-        api_key = os.environ.get("OPENAI_API_KEY")
-        if not api_key:
-            raise ValueError("OPENAI_API_KEY environment variable is not set")
-        
-        # Create the client
-        client = AsyncOpenAI(api_key=api_key)
+        # Reuse the shared client instead of opening a new connection per document
+        client = get_openai_client()
         
         # Check if the file is a local path
         if document_url.startswith("file://"):
@@ -79,15 +106,14 @@ async def verify_document_with_vision(document_url: str, session_id: Optional[st
             
             # Upload to Cloudinary if available
             cloudinary_result = None
-            if cloudinary_storage and cloudinary_storage.is_available:
+            if upload_to_cloudinary and cloudinary_storage and cloudinary_storage.is_available:
                 logger.info(f"Uploading document to Cloudinary: {file_path}")
                 cloudinary_result = await cloudinary_storage.upload_document(file_path)
                 if cloudinary_result:
                     logger.info(f"Document uploaded to Cloudinary: {cloudinary_result['secure_url']}")
             
-            # Read the file as binary and encode as base64
-            with open(file_path, "rb") as file:
-                base64_data = base64.b64encode(file.read()).decode('utf-8')
+            # Read the file as binary and encode as base64, off the event loop
+            base64_data = await asyncio.to_thread(read_base64, file_path)
             
             filename = os.path.basename(file_path)
             
@@ -153,13 +179,14 @@ async def verify_document_with_vision(document_url: str, session_id: Optional[st
         
         # Determine if document is valid based on analysis
         # Enhanced validation logic to better detect valid documents and reduce false negatives
-        is_valid = (
+        analysis_lc = analysis.lower()
+        is_valid = bool(
             # Look for positive indicators
-            ("valid" in analysis.lower() or "acceptable" in analysis.lower() or "good quality" in analysis.lower()) and
+            VALID_RE.search(analysis_lc) and
             # Check for clarity indicators
-            ("clear" in analysis.lower() or "legible" in analysis.lower() or "readable" in analysis.lower()) and
+            CLARITY_RE.search(analysis_lc) and
             # Reject only if explicitly mentioned problems
-            not any(issue in analysis.lower() for issue in ["blurry", "unclear", "cannot read", "illegible", "fake", "forged", "manipulated"])
+            not PROBLEM_RE.search(analysis_lc)
         )
         
         logger.info(f"Document validation result: {is_valid}, based on analysis: {analysis[:100]}...")
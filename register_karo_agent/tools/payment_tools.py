@@ -2,6 +2,7 @@ import os
 import logging
 import uuid
 import random
+from functools import lru_cache
 from typing import Dict, Any
 
 # Configure logging
@@ -16,6 +17,14 @@ except ImportError:
     RAZORPAY_SDK_AVAILABLE = False
     logger.warning("Razorpay SDK not installed. Using simulated payment flow.")
 
+@lru_cache(maxsize=4)
+def get_razorpay_client(key_id: str, key_secret: str):
+    """
+    Return a Razorpay client for the given credentials.
+    The client is cached so its HTTP session (and TLS connection) is reused across calls.
+    """
+    return razorpay.Client(auth=(key_id, key_secret))
+
 def generate_razorpay_link(customer_info: Dict[str, Any] = None) -> Dict[str, Any]:
     """
     Generate a payment link for company incorporation fees using Razorpay.
@@ -53,8 +62,8 @@ def generate_razorpay_link(customer_info: Dict[str, Any] = None) -> Dict[str, An
         # Try to use actual Razorpay SDK if available
         if RAZORPAY_SDK_AVAILABLE and razorpay_key_id and razorpay_key_secret and razorpay_key_id != "rzp_test_placeholder":
             try:
-                # Initialize the Razorpay client
-                client = razorpay.Client(auth=(razorpay_key_id, razorpay_key_secret))
+                # Get the shared Razorpay client
+                client = get_razorpay_client(razorpay_key_id, razorpay_key_secret)
                 
                 # Create a payment link using Razorpay API
                 logger.info("Using Razorpay API to generate actual payment link")
@@ -158,8 +167,8 @@ def check_payment_status(payment_id: str) -> Dict[str, Any]:
         # Try to use actual Razorpay SDK if available
         if RAZORPAY_SDK_AVAILABLE and razorpay_key_id and razorpay_key_secret and razorpay_key_id != "rzp_test_placeholder":
             try:
-                # Initialize the Razorpay client
-                client = razorpay.Client(auth=(razorpay_key_id, razorpay_key_secret))
+                # Get the shared Razorpay client
+                client = get_razorpay_client(razorpay_key_id, razorpay_key_secret)
                 
                 logger.info("Using Razorpay API to check payment status")
                 